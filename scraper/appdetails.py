@@ -1,11 +1,13 @@
 from scraper.db_util import (
-    db_connect, upsert, app_table_name, exists, _id_column_type, get_all_terms, get_all_terms_LANG_COUNTRY, reviews_table_name,
+    db_connect, query, upsert, upsert_many, insert_or_ignore, app_table_name,
+    ensure_desc_tables, text_hash, retry_locked, texts_table_name, desc_history_table_name,
+    desc_latest_table_name, exists, _id_column_type, get_all_terms, get_all_terms_LANG_COUNTRY, reviews_table_name,
 )
-from scraper.appstore_api import get_store_func
+from scraper.appstore_api import get_store_func, get_store_batch
+from scraper import refresh, cache, tracing
 import scraper.config as config
 import json
 import sys
-from datetime import datetime
 
 logger = config.setup_logger()
 SERIALIZED_KEYS = [
@@ -16,19 +18,34 @@ SERIALIZED_KEYS = [
     'ipadScreenshots', 'supportedDevices'
 ]
 
+# Similar apps and permissions are cached (see cache.TTLCache), so that an
+# app refresh or an app closure does not ask for them again every time.
+similar_cache = cache.TTLCache('similar', config.SIMILAR_CACHE_TTL)
+permissions_cache = cache.TTLCache('permissions', config.PERMISSIONS_CACHE_TTL)
+
+
 def get_similar_apps(appid, store, limit=50):
+    """Similar apps of @appid, cached for config.SIMILAR_CACHE_TTL seconds"""
     similar = get_store_func('similar', store)
-    return [
-        a['appId'] for a in
-        similar({'appId': appid, 'lang':config.LANG, 'country':config.COUNTRY, 'fullDetail': False, 
-                 'throttle': config.THROTTLE_DEFAULT})
-    ][:limit]
+    return similar_cache.get_or_compute(
+        (store, appid, config.lang(), config.country()),
+        lambda: [
+            a['appId'] for a in
+            similar({'appId': appid, 'lang':config.lang(), 'country':config.country(), 'fullDetail': False})
+        ]
+    )[:limit]
 
 
-def get_permissions(appid, store):
+def get_permissions(appid, store, version=None):
+    """Permissions of @appid. They only change with a new version, so they
+    are cached per @version (for config.PERMISSIONS_CACHE_TTL seconds), and
+    shared by all the locales."""
     if store != 'android': return ['Not Available']
     permissions = get_store_func('permissions', store)
-    return permissions({'appId': appid, 'short': True})
+    return permissions_cache.get_or_compute(
+        (store, appid, version),
+        lambda: permissions({'appId': appid, 'short': True})
+    )
 
 
 def get_app_details(appid, store):
@@ -41,13 +58,13 @@ def get_app_details(appid, store):
         # app_table_name(store), primary_id='appId', primary_type=_id_column_type()
         app_table_name(store)
     )
-    already_exists = exists(table, 'appId', appid, time_check=force)    
+    already_exists = exists(table, 'appId', appid)
     if not already_exists:
         return []
     
-    ret = list(db.query(
-        'select * from {0} where appId="{1}" COLLATE NOCASE order by time'
-            .format(table.table.name, appid)
+    ret = list(query(
+        'select * from {0} where appId=:appid COLLATE NOCASE order by time'
+            .format(table.table.name), appid=appid
     ))[0]
     for k in SERIALIZED_KEYS:
         if k in ret:
@@ -60,9 +77,29 @@ def get_app_details(appid, store):
     return ret
 
 
-def download_app_details(appid, store, force=False):
+def _app_query(appid, store, table, force=False):
+    """(query of the store's app call, appid, already_exists) of @appid. ios
+    apps can also be given by their numeric id ('id123' or '123').
+    """
+    if store == 'ios' and (appid.startswith('id') or appid.isdigit()):
+        already_exists = exists(table, 'iosid', appid, time_check=force)
+        if already_exists:
+            appid = table.find_one(iosid=appid)['appId']
+        return {'id': appid.replace('id', '')}, appid, already_exists
+    already_exists = exists(table, 'appId', appid, time_check=force)
+    return ({'appId': appid, 'lang':config.lang(), 'country':config.country()},
+            appid, already_exists)
+
+
+def fetch_app_details(appid, store, force=False, fetches=None):
     """Downloads details of an app (@appid) from the corresponding store (@store),
-    and saves it as necessary. 
+    and returns the row (with serialized values) to be saved in the app table.
+    The similar apps and permissions are only fetched for new apps and apps
+    that changed (see refresh.py); for the others, only {'appId': appid} is
+    returned, which marks the app as seen (save_app_details).
+    Returns None if there is nothing to save.
+    The refresh metadata of the fetch is added to @fetches, to be saved with
+    the row (save_app_details), or saved right away if @fetches is None.
     """
 
     db = db_connect()
@@ -70,37 +107,91 @@ def download_app_details(appid, store, force=False):
         # app_table_name(store), primary_id='appId', primary_type=_id_column_type()
         app_table_name(store)
     )
+    q, appid, already_exists = _app_query(appid, store, table, force=force)
+    ret = get_store_func('app', store)(q)
+    recorder = refresh.FetchRecorder(store, [appid])
+    row = _app_row(q, appid, ret, store, table, already_exists, recorder)
+    if fetches is None:
+        recorder.flush()
+    else:
+        fetches.extend(recorder.take())
+    return row
 
-    already_exists = exists(table, 'appId', appid, time_check=force)
 
+def fetch_app_details_batches(appids, store, force=False, batch_size=None):
+    """fetch_app_details of many apps, @batch_size (config.APP_BATCH_SIZE) apps
+    per call of the app_batch endpoint of server.js, which fetches them
+    concurrently and streams them back. Yields (appids of the batch, their
+    rows, their refresh metadata) per batch; save the metadata with the rows
+    (save_app_details), so no app is marked as fetched before it is saved.
+    If a batch call fails (e.g., an older server.js), the apps of that batch
+    it did not return are fetched one by one.
+    """
+    batch_size = batch_size or config.APP_BATCH_SIZE
+    app_batch = get_store_batch('app', store)
     appfunc = get_store_func('app', store)
+    db = db_connect()
+    table = db.get_table(app_table_name(store))
+    for i in range(0, len(appids), batch_size):
+        batch = appids[i:i + batch_size]
+        pending = [_app_query(appid, store, table, force=force) for appid in batch]
+        items = {}
+        with tracing.span('app_batch', 'python', n=len(batch)):
+            # The stream is read to the end first, so that the node worker is
+            # released before the rows need other calls (similar apps,
+            # permissions)
+            try:
+                for item in app_batch([q for q, _, _ in pending]):
+                    if not item['ok']:
+                        logger.debug("app_batch: {} >> {}".format(
+                            item['appId'], item['error']))
+                    items[item['i']] = item
+            except Exception as e:
+                logger.info("app_batch failed ({}), fetching the rest of "
+                            "the batch one by one: {}".format(store, e))
+            recorder = refresh.FetchRecorder(store, [appid for _, appid, _ in pending])
+            rows = []
+            for k, (q, appid, already_exists) in enumerate(pending):
+                item = items.get(k)
+                # store_ms: the time of the app call in server.js
+                attrs = {'store_ms': item.get('ms')} if item else {}
+                with tracing.span('app', 'app', appId=appid, **attrs) as s:
+                    if item is None:
+                        ret = appfunc(q)
+                    elif item['ok']:
+                        ret = item['result']
+                    else:
+                        s.attrs['error'] = item['error']
+                        ret = []
+                    rows.append(_app_row(q, appid, ret, store, table,
+                                         already_exists, recorder))
+        yield batch, rows, recorder.take()
 
-    if store == 'ios' and (appid.startswith('id') or appid.isdigit()):
-        already_exists = exists(table, 'iosid', appid, time_check=force)
-        if already_exists:
-            appid = table.find_one(iosid=appid)['appId']
-        ret = appfunc({'id': appid.replace('id', ''),
-                       'throttle': config.THROTTLE_DEFAULT})
-        if ret: 
-            ret['iosid'] = ret['id']
-            del ret['id']
-            appid = ret['appId']
-    else:
-        ret = appfunc({'appId': appid, 'lang':config.LANG, 'country':config.COUNTRY, 'throttle': config.THROTTLE_DEFAULT})
 
+def _app_row(q, appid, ret, store, table, already_exists, recorder):
+    """The row to save for the result @ret of the app call with query @q
+    (see fetch_app_details). The fetch is recorded with @recorder
+    (refresh.FetchRecorder)."""
+    if ret and 'id' in q:  # ios app asked by its numeric id
+        ret['iosid'] = ret['id']
+        del ret['id']
+        appid = ret['appId']
+
+    refresh.count_stage('detail')
     if ret and not ret['appId']:   # WTF is going on
         logger.warning("WTF: appId={}, store={}".format(appid, store))
         return None
+    # The refresh metadata, not already_exists (with force, an app row
+    # saved today), says if the app was fetched before and what changed
+    changed, known = recorder.record(appid, ret)
 
     if not ret:
-        if already_exists:
-            q = "update {table} set discontinued={time!r} where "\
-                "appId={appid!r} and discontinued is null".format(
-                    table=table.table.name,
-                    time=config.now(),
-                    appid=appid
-                )
-            db.query(q)
+        refresh.count_stage('gone')
+        if already_exists or known:
+            sql = "update {table} set discontinued=:time where "\
+                "appId=:appid and discontinued is null".format(
+                    table=table.table.name)
+            query(sql, time=config.now(), appid=appid)
         logger.info("No app with appId={}".format(appid))
         return None
     # get permissions and similar apps Similar apps was supposed to be
@@ -109,26 +200,29 @@ def download_app_details(appid, store, force=False):
     # similar apps
     # ret['similar'] = [ x for x in get_closure_of_apps([appid],
     #     store=store, limit=config.APPS_PER_QUERY) ]
-    ret['similar'] = get_similar_apps(appid, store=store)
 
-    # If the app is in the playstore updated long time ago (more than a month),
-    # then we already have the most updated version.
-    if already_exists and \
-       (datetime.now().timestamp() - float(ret['updated']) > 30 * 86400):
-        return None
+    # The app did not change (updated, version) since its last fetch, so we
+    # already have the most updated version.
+    if known and not changed:
+        refresh.count_stage('unchanged')
+        return {'appId': appid}
+    refresh.count_stage('changed')
+    refresh.count_stage('similar')
+    ret['similar'] = get_similar_apps(appid, store=store)
     if store == 'android':
+        refresh.count_stage('permissions')
         # ret['permissions'] = [x for x in permissions({'appId': appid,
         # 'short': True})]
-        ret['permissions'] = get_permissions(appid, store)
-        ret['LANG'] = config.LANG
-        ret['COUNTRY'] = config.COUNTRY
+        ret['permissions'] = get_permissions(appid, store, version=ret.get('version'))
+        ret['LANG'] = config.lang()
+        ret['COUNTRY'] = config.country()
     else:
         ret['permissions'] = ['<not available>']
     ret['time'] = config.now()
     ret['lastseen'] = ret['time']
     ret['discontinued'] = None
-    ret['LANG'] = config.LANG
-    ret['COUNTRY'] = config.COUNTRY
+    ret['LANG'] = config.lang()
+    ret['COUNTRY'] = config.country()
     serialize_keys = ['terms', 'apps']
     for k, v in ret.items():
         if isinstance(v, (list, set, dict)):
@@ -137,82 +231,171 @@ def download_app_details(appid, store, force=False):
     for k in ret:
         if isinstance(ret[k], (list, set)):
             logger.warning("get_app_details.1 >> ", store, k)
-    upsert(table, ret, ['appId', 'description', 'title',
-                        'permissions', 'updated'])
-
-    q = "update {table} set lastseen={time!r} where "\
-        "appId={appid!r}".format(
-            table=table.table.name,
-            time=config.now(),
-            appid=ret['appId']
+    update_desc_table(ret, store)
+    return ret
+
+
+def update_desc_table(ret, store):
+    """Records the tracked text fields (config.TRACKED_TEXT_FIELDS) of the app in
+    @ret that changed since the last time. Changes are detected by comparing
+    the hash of the text with the latest hash stored for the app and locale;
+    the text itself is stored once per distinct hash.
+    Returns the list of fields that changed.
+    """
+    ensure_desc_tables(store)
+    db = db_connect()
+    lang, country = ret.get('LANG', config.lang()), ret.get('COUNTRY', config.country())
+    latest = {
+        r['field']: r['hash'] for r in query(
+            'select field, hash from {} where appId=:appid and LANG=:lang '
+            'and COUNTRY=:country'.format(desc_latest_table_name(store)),
+            appid=ret['appId'], lang=lang, country=country
+        )
+    }
+    changed = []
+    for field in config.TRACKED_TEXT_FIELDS:
+        text = ret.get(field)
+        if text is None:
+            continue
+        if not isinstance(text, str):
+            text = json.dumps(text)
+        h = text_hash(text)
+        if latest.get(field) != h:
+            changed.append((field, h, text))
+    if not changed:
+        return []
+    params = {'appid': ret['appId'], 'lang': lang, 'country': country,
+              'time': config.now()}
+    def _write():
+        with db:
+            for field, h, text in changed:
+                params.update(field=field, hash=h, text=text)
+                query('insert or ignore into {} (hash, text) values '
+                      '(:hash, :text)'.format(texts_table_name(store)), **params)
+                query('insert into {} (appId, field, LANG, COUNTRY, hash, time) '
+                      'values (:appid, :field, :lang, :country, :hash, :time)'
+                      .format(desc_history_table_name(store)), **params)
+                query('insert or replace into {} (appId, field, LANG, COUNTRY, '
+                      'hash, time) values (:appid, :field, :lang, :country, '
+                      ':hash, :time)'.format(desc_latest_table_name(store)),
+                      **params)
+    try:
+        retry_locked(_write)
+    except Exception as e:
+        logger.exception("Exception.update_desc_table!! {}".format(e))
+        return []
+    return [field for field, _, _ in changed]
+
+
+APP_CHECK_COLS = ['appId', 'description', 'title', 'permissions', 'updated']
+
+
+def save_app_details(rows, store, fetches=None):
+    """Saves the rows returned by fetch_app_details in one go, and marks all of
+    those apps as seen now. The refresh metadata of their fetches (@fetches)
+    is written in the same transaction. Returns (inserted, skipped) rows.
+    """
+    db = db_connect()
+    with db:
+        inserted, skipped = _save_app_rows(rows, store)
+        if fetches:
+            refresh.save_fetches(store, fetches)
+    return inserted, skipped
+
+
+def _save_app_rows(rows, store):
+    rows = [r for r in rows if r]
+    if not rows:
+        return [], []
+    db = db_connect()
+    table = db.get_table(app_table_name(store))
+    # Rows with only the appId are the unchanged apps, only marked as seen
+    inserted, skipped = upsert_many(table, [r for r in rows if len(r) > 1],
+                                    APP_CHECK_COLS)
+
+    appids = list(set(r['appId'] for r in rows))
+    for i in range(0, len(appids), 900):
+        _ids = appids[i:i + 900]
+        params = {'a{}'.format(j): a for j, a in enumerate(_ids)}
+        params['time'] = config.now()
+        query(
+            "update {table} set lastseen=:time where appId in ({ids})".format(
+                table=table.table.name,
+                ids=', '.join(':a{}'.format(j) for j in range(len(_ids)))
+            ), **params
         )
-    db.query(q)
+    return inserted, skipped
 
 
-def download_reviews(appid, store, limit=100):
+def download_app_details(appid, store, force=False):
+    """Downloads details of an app (@appid) from the corresponding store (@store),
+    and saves it as necessary. 
+    """
+    fetches = []
+    ret = fetch_app_details(appid, store, force=force, fetches=fetches)
+    save_app_details([ret], store, fetches)
+
+
+def _count_reviews(table, appid):
+    try:
+        return int(query(
+            'select count(*) c from {} where appId=:appid COLLATE NOCASE'
+                .format(table.table.name), appid=appid
+        ).next()['c'])
+    except Exception as e:
+        print(e, table.name, appid, file=sys.stderr)
+        return 0
+
+
+def iter_reviews(appid, store, limit=100):
+    """Downloads the reviews of @appid page by page, saves each page and yields
+    it. Reviews already in the db are skipped by their primary key (id). Stops
+    once the db has min(@limit, #reviews of the app) reviews of the app, or the
+    store has no more pages. Only the current page is kept in memory.
+    """
     db = db_connect()
     # Id provided for each app
     table = db.get_table(reviews_table_name(store), primary_id='id',
                          primary_type=_id_column_type())
-    db.commit()
     # table.create_index(['appId'])
     reviews_func = get_store_func('reviews', store)
     page = 0
-    have_seen_this_app = exists(table, 'appId', appid)
-    rev_tot = 2 ** 32 - 1
-    try:
-        rev_count = int(db.query(
-            'select count(*) c from {} where appId={!r} COLLATE NOCASE'
-                .format(table.table.name, appid)
-        ).next()['c'])
-    except Exception as e:
-        print(e, store, e, appid, file=sys.stderr)
-        rev_count = 0
-
+    rev_count = _count_reviews(table, appid)
     try:
-        rev_tot = int(db.query(
-            'select reviews from {} where appId={!r} COLLATE NOCASE'
-                .format(app_table_name(store), appid)
+        rev_tot = int(query(
+            'select reviews from {} where appId=:appid COLLATE NOCASE'
+                .format(app_table_name(store)), appid=appid
         ).next()['reviews'])
     except Exception as e:
         print("download_reviews.1>>", store, e, appid, file=sys.stderr)
         rev_tot = rev_count * 2
 
-    ids_already_there = set()
-    comments = []
-    if rev_count > 0:
-        comments = list(table.find(appId=appid))
-        ids_already_there = set(
-            str(r['id']) for r in
-            db.query(
-                'select id from {tabname} where appId="{appid}" COLLATE NOCASE'
-                    .format(tabname=table.table.name, appid=appid)
-            )
-        )
-
-    def add_appid(d):
-        d['appId'] = appid
-        return d
-
-    while len(comments) < min(limit, rev_tot):
-        # Google is real angry, setting the throttle to 2 req per sec.
-        ret = reviews_func({'appId': appid, 'page': page, 'lang':config.LANG,
-                            'throttle': config.THROTTLE_DEFAULT-3}) 
+    while rev_count < min(limit, rev_tot):
+        # Google is real angry, the rate limiter starts reviews at 2 req per
+        # sec (config.RATE_LIMITS).
+        ret = reviews_func({'appId': appid, 'page': page, 'lang':config.lang()})
         if not ret: break
-        ret = [add_appid(r) for r in ret if r['id'] not in ids_already_there]
+        for r in ret:
+            r['appId'] = appid
         assert len(ret) == len(set(r['id'] for r in ret)), ret
-
-        rev_count += len(ret)
         page += 1
         try:
-            table.insert_many(ret)
+            rev_count += retry_locked(insert_or_ignore, table, ret)
         except Exception as e:
             logger.exception(e)
             logger.info(json.dumps(ret, indent=4))
-            logger.info(ids_already_there)
             print("Could not insert. Exiting.... See appscraper.log")
             exit(-1)
-        ids_already_there |= set(r['id'] for r in ret)
-        comments.extend(ret)
-    db.commit()
-    return comments
+        yield ret
+
+
+def download_reviews(appid, store, limit=100):
+    """Downloads the reviews of @appid (see iter_reviews), returns the number
+    of new reviews saved.
+    """
+    table = db_connect().get_table(reviews_table_name(store), primary_id='id',
+                                   primary_type=_id_column_type())
+    before = _count_reviews(table, appid)
+    for _ in iter_reviews(appid, store, limit=limit):
+        pass
+    return _count_reviews(table, appid) - before
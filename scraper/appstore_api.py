@@ -2,34 +2,70 @@
 File to connect to the js server server.js that scrapes both Play Store and iTune App Store.
 """
 import subprocess
+import threading
+import itertools
 import zerorpc
-from . import config
+from . import config, ratelimit, http_client, metrics, tracing
 import time
 import os
 
-sock_path_prefix = config.SOCK_PATH
-pythonc = None
+# zerorpc clients are gevent based and cannot be shared between threads, so
+# every thread gets its own client per (store, worker).
+_clients = threading.local()
+# Bumped by connect(fresh=True), so that every thread drops its old clients
+_generation = {}
+_server_lock = threading.Lock()
+# Pool of config.NODE_WORKERS node servers per store. Calls are sent to the
+# worker with the least outstanding requests, ties are broken round robin.
+_started = set()
+_outstanding = {}
+_pool_lock = threading.Lock()
+_round_robin = itertools.count()
 __package__ = ['scraper.appstore_api']
 
+
+def sock_path(store, worker=0):
+    """Unix socket the @worker-th node server of @store listens on"""
+    return '{}_{}_{}.sock'.format(config.SOCK_PATH, store, worker)
+
+
 def connect(store, fresh=False):
-    global pythonc
-    sock_path = '{}_{}.sock'.format(sock_path_prefix, store)
+    """Starts the pool of node servers for @store, if not already running.
+    With @fresh the running servers are killed and restarted, and all the
+    threads reconnect on their next call.
+    """
     assert store in ('android', 'ios'), "Store={!r} not supported".format(store)
     server_js_path = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), 'server.js'
     )
-    if fresh:  # Kill the process
+    with _server_lock:
+        if store in _started and not fresh:
+            return
+        for i in range(config.NODE_WORKERS):
+            _start_server(store, sock_path(store, i), server_js_path, fresh)
+        with _pool_lock:
+            # Calls may be in flight on a restart, their counts are kept
+            if store not in _outstanding:
+                _outstanding[store] = [0] * config.NODE_WORKERS
+        if fresh:
+            _generation[store] = _generation.get(store, 0) + 1
+        _started.add(store)
+
+
+def _start_server(store, sock_path, server_js_path, fresh=False):
+    if fresh and os.path.exists(sock_path):  # Kill the process
         subprocess.run('kill -9 `lsof -t {}`'.format(sock_path),
                        shell=True)
         time.sleep(1)
-        os.remove(sock_path)
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
 
     if not os.path.exists(sock_path):
-        print("Starting js server: {}".format(server_js_path))
+        print("Starting js server: {} ({})".format(server_js_path, sock_path))
         # --max-old-space-size=8192 means, Node can use upto 8192mb space.  
         jsprog = subprocess.Popen(
-            'node --max-old-space-size=8192 {0} {1} 1>>{2} 2>&1 &'
-            .format(server_js_path, store, config.JS_SERVER_LOG_FILE),
+            'node --max-old-space-size=8192 {0} {1} {2} 1>>{3} 2>&1 &'
+            .format(server_js_path, store, sock_path, config.JS_SERVER_LOG_FILE),
             shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -37,24 +73,134 @@ def connect(store, fresh=False):
         )  # start if not already running, use memoization benefits
         time.sleep(0.01)
 
+
+def _client(store, worker):
+    """zerorpc client of the current thread for the @worker-th server"""
+    if store not in _started:
+        connect(store)
+    key = (store, worker)
+    generation = _generation.get(store, 0)
+    cached = _clients.__dict__.get(key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    if cached is not None:  # the servers were restarted since
+        cached[1].close()
     # python client
     pythonc = zerorpc.Client()
     # pythonc.connect('tcp://0.0.0.0:4242')
-    pythonc.connect('ipc://{}'.format(sock_path))
+    pythonc.connect('ipc://{}'.format(sock_path(store, worker)))
+    _clients.__dict__[key] = (generation, pythonc)
+    return pythonc
 
 
-def get_store_func(func_name, store):
-    # It is dangerous to use eval, but this is a cute little script,
-    # so I am doing it.
-    if pythonc is None:
+def _acquire_worker(store):
+    """Picks the worker with the least outstanding requests"""
+    if store not in _started:
         connect(store)
-    return eval('pythonc.{}_{}'.format(store,func_name))
+    with _pool_lock:
+        counts = _outstanding[store]
+        start = next(_round_robin)
+        worker = min(
+            ((start + k) % len(counts) for k in range(len(counts))),
+            key=lambda i: counts[i]
+        )
+        counts[worker] += 1
+    return worker
+
+
+def _release_worker(store, worker):
+    with _pool_lock:
+        _outstanding[store][worker] -= 1
+
+
+def get_store_func(func_name, store):
+    """Returns a callable for the store api `<store>_<func_name>` exposed by
+    server.js. Each call is routed to one of the node servers of the store,
+    and the client is looked up when the function is called, so the returned
+    function can be used from any thread.
+    All the calls go through the rate limiter of (store, func_name), and are
+    recorded in the metrics (metrics.py).
+    """
+    method = '{}_{}'.format(store, func_name)
+
+    def _call(*args, **kwargs):
+        with tracing.span('ratelimit', 'wait'):
+            ratelimit.acquire(store, func_name)
+        worker = _acquire_worker(store)
+        t = time.time()
+        try:
+            with tracing.span(method, 'rpc', worker=worker):
+                res = getattr(_client(store, worker), method)(*args, **kwargs)
+        except Exception:
+            metrics.record(store, func_name, time.time() - t, error=True)
+            ratelimit.report(store, func_name, ratelimit.ERROR)
+            raise
+        finally:
+            _release_worker(store, worker)
+        metrics.record(store, func_name, time.time() - t, res)
+        ratelimit.report(store, func_name,
+                         ratelimit.OK if res else ratelimit.EMPTY)
+        return res
+    _call.__name__ = method
+    return _call
+
+
+def get_store_batch(func_name, store):
+    """Returns a generator function for the batch api `<store>_<func_name>_batch`
+    of server.js. It takes a list of queries, which server.js runs
+    @concurrency (config.APP_BATCH_CONCURRENCY) at a time, and yields the
+    {'i', 'appId', 'ok', 'result' or 'error'} of every query as soon as it is
+    streamed back, in the order they finish.
+    The queries go through the rate limiter and the metrics of (store,
+    func_name), like the calls of get_store_func; the batch call itself is
+    recorded as `<func_name>_batch`.
+    """
+    method = '{}_{}_batch'.format(store, func_name)
+
+    def _call(queries, concurrency=None):
+        if not queries:
+            return
+        with tracing.span('ratelimit', 'wait'):
+            ratelimit.acquire(store, func_name, n=len(queries))
+        worker = _acquire_worker(store)
+        t = time.time()
+        try:
+            with tracing.span(method, 'rpc', worker=worker, n=len(queries)):
+                stream = getattr(_client(store, worker), method)({
+                    'queries': queries,
+                    'concurrency': concurrency or config.APP_BATCH_CONCURRENCY
+                })
+            # An empty batch is answered with a plain [] instead of a stream
+            stream = iter(stream)
+            while True:
+                with tracing.span(method, 'rpc', worker=worker):
+                    item = next(stream, None)
+                if item is None:
+                    break
+                res = item.get('result') if item.get('ok') else None
+                metrics.record(store, func_name, item.get('ms', 0) / 1000.0,
+                               res, error=not item.get('ok'))
+                # A failed query is mostly an app gone from the store, so it
+                # counts as empty (the way get_store_func sees it), not error
+                ratelimit.report(store, func_name,
+                                 ratelimit.OK if res else ratelimit.EMPTY)
+                yield item
+        except Exception:
+            metrics.record(store, func_name + '_batch', time.time() - t,
+                           error=True)
+            ratelimit.report(store, func_name, ratelimit.ERROR)
+            raise
+        finally:
+            _release_worker(store, worker)
+        # The payloads are counted per query, above
+        metrics.record(store, func_name + '_batch', time.time() - t, len(queries))
+    _call.__name__ = method
+    return _call
 
 
 def app_page(appid, store='android'):
     assert store == 'android', "Not supported for other store={}".format(store)
     url = "https://play.google.com/store/apps/details?id="
-    r = requests.get(url + appid)
-    time.sleep(random.random()*2)
+    r = http_client.get(url + appid, store, 'app_page')
     print("Checked {} returned {}".format(appid, r))
     return r
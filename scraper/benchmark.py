@@ -0,0 +1,134 @@
+"""
+End-to-end throughput benchmark of the crawl pipeline
+(download_all_terms_appids -> download_app_details_all -> reviews), run
+against the fake store servers in fake_store.py and a scratch database, so
+that nothing goes to Google or Apple.
+
+$ python -m scraper.benchmark --appstore android --latency 0.05 --limit 200
+
+Prints terms/s, apps/s, reviews/s and the bytes written to the db, and
+optionally saves them as json (--out) to compare runs.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from scraper import config
+from scraper.appstore_api import sock_path
+
+
+def start_fake_servers(store, args):
+    procs = []
+    for i in range(config.NODE_WORKERS):
+        path = sock_path(store, i)
+        procs.append(subprocess.Popen([
+            sys.executable, '-m', 'scraper.fake_store', store, path,
+            '--latency', str(args.latency),
+            '--error-rate', str(args.error_rate),
+            '--num-apps', str(args.num_apps)
+        ], stdout=subprocess.DEVNULL))
+        while not os.path.exists(path):
+            time.sleep(0.05)
+    return procs
+
+
+def _count(db, table):
+    try:
+        return list(db.query('select count(*) c from {}'.format(table)))[0]['c']
+    except Exception:
+        return 0
+
+
+def _db_bytes(path):
+    return sum(os.path.getsize(f) for f in (path, path + '-wal')
+               if os.path.exists(f))
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='appscraper_bench_')
+    config.SOCK_PATH = os.path.join(tmpdir, 'fake')
+    config.DATA_DIR = tmpdir
+    config.TEST_DB_FILE = os.path.join(tmpdir, 'bench.db')
+    config.CLOSURE_SIZE_LIMIT = args.limit
+    config.NODE_WORKERS = args.workers
+    config.CLOSURE_WORKERS = args.closure_workers
+    config.THROTTLE_DEFAULT = config.RATE_LIMIT_MAX = args.rate
+    config.RATE_LIMITS = {}
+    store = args.appstore
+    procs = start_fake_servers(store, args)
+
+    from scraper import pyscraper, db_util
+    from scraper.appdetails import download_reviews
+    try:
+        db = db_util.db_connect(test=True)
+        results = {'store': store, 'latency': args.latency,
+                   'error_rate': args.error_rate, 'limit': args.limit,
+                   'workers': args.workers,
+                   'closure_workers': args.closure_workers}
+
+        t = time.time()
+        pyscraper.download_all_terms_appids(store, test=True)
+        results['terms_sec'] = time.time() - t
+        results['terms'] = _count(db, db_util.term_table_name(store))
+
+        t = time.time()
+        pyscraper.download_app_details_all(store, test=True)
+        results['apps_sec'] = time.time() - t
+        results['apps'] = _count(db, db_util.app_table_name(store))
+
+        t = time.time()
+        appids = [r['appId'] for r in db.query(
+            'select distinct appId from {}'.format(db_util.app_table_name(store)))]
+        for appid in appids[:args.review_apps]:
+            download_reviews(appid, store=store,
+                             limit=config.NUM_COMMENTS_TO_DOWNLOAD)
+        results['reviews_sec'] = time.time() - t
+        results['reviews'] = _count(db, db_util.reviews_table_name(store))
+        results['db_bytes'] = _db_bytes(config.TEST_DB_FILE)
+    finally:
+        for p in procs:
+            p.terminate()
+
+    for k in ('terms', 'apps', 'reviews'):
+        results[k + '_per_sec'] = results[k] / max(results[k + '_sec'], 1e-9)
+    return results
+
+
+def arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the crawl against a local fake store")
+    parser.add_argument('--appstore', default='android', choices=['android', 'ios'])
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Mean latency of a store call in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of the store calls that return []")
+    parser.add_argument('--num-apps', type=int, default=5000,
+                        help="Size of the fake app catalog")
+    parser.add_argument('--limit', type=int, default=100,
+                        help="Closure size limit (config.CLOSURE_SIZE_LIMIT)")
+    parser.add_argument('--workers', type=int, default=config.NODE_WORKERS,
+                        help="Number of fake servers (config.NODE_WORKERS)")
+    parser.add_argument('--closure-workers', type=int, default=config.CLOSURE_WORKERS,
+                        help="config.CLOSURE_WORKERS")
+    parser.add_argument('--rate', type=float, default=1000,
+                        help="Starting rate limit, req/sec")
+    parser.add_argument('--review-apps', type=int, default=100,
+                        help="Download reviews of these many apps")
+    parser.add_argument('--out', help="Save the results as json in this file")
+    return parser
+
+
+if __name__ == "__main__":
+    args = arguments().parse_args()
+    results = run(args)
+    print("{:>10s} {:>10s} {:>10s} {:>10s}".format('', 'count', 'sec', 'per sec'))
+    for k in ('terms', 'apps', 'reviews'):
+        print("{:>10s} {:>10d} {:>10.1f} {:>10.1f}".format(
+            k, results[k], results[k + '_sec'], results[k + '_per_sec']))
+    print("DB bytes written: {}".format(results['db_bytes']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,106 @@
+"""
+A persistent cache of the results of (slow, rate limited) store calls, kept
+in a `cache_<name>` table of the crawl db, so that it is shared by all the
+closures of a run and by the next runs.
+
+    suggest_cache = TTLCache('suggest', config.SUGGEST_CACHE_TTL)
+    terms = suggest_cache.get_or_compute(
+        (store, term, lang, country), lambda: suggest(term))
+
+The values are stored as json, and are used for @ttl seconds after they
+were fetched. Empty results are not cached by default, since that is how
+server.js reports most errors.
+"""
+import json
+import threading
+import time
+from scraper import config
+from scraper.db_util import db_connect, retry_locked
+
+logger = config.setup_logger()
+
+_caches = {}
+
+
+class TTLCache(object):
+    """A sqlite backed {key: value} cache whose entries expire after @ttl
+    seconds. Keys are tuples of json-able values."""
+
+    def __init__(self, name, ttl, cache_empty=False):
+        self.name = name
+        self.table = 'cache_{}'.format(name)
+        self.ttl = ttl
+        self.cache_empty = cache_empty
+        self.hits = self.misses = self.expired = 0
+        self._lock = threading.Lock()
+        self._created = False
+        _caches[name] = self
+
+    def _db(self):
+        db = db_connect()
+        if not self._created:
+            retry_locked(
+                db.query,
+                'create table if not exists {} (key text primary key, '
+                'value text, time real)'.format(self.table)
+            )
+            self._created = True
+        return db
+
+    def _count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def get(self, key, default=None):
+        """Cached value of @key, or @default if it is not cached or is older
+        than the ttl"""
+        rows = list(self._db().query(
+            'select value, time from {} where key=:key'.format(self.table),
+            key=json.dumps(key)
+        ))
+        if not rows:
+            self._count('misses')
+            return default
+        if rows[0]['time'] < time.time() - self.ttl:
+            self._count('expired')
+            return default
+        self._count('hits')
+        return json.loads(rows[0]['value'])
+
+    def set(self, key, value):
+        if not value and not self.cache_empty:
+            return
+        retry_locked(
+            self._db().query,
+            'insert or replace into {} (key, value, time) values '
+            '(:key, :value, :time)'.format(self.table),
+            key=json.dumps(key), value=json.dumps(value), time=time.time()
+        )
+
+    def get_or_compute(self, key, func):
+        """Cached value of @key, or calls @func() and caches its result"""
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def purge(self):
+        """Deletes the expired entries"""
+        retry_locked(
+            self._db().query,
+            'delete from {} where time < :t'.format(self.table),
+            t=time.time() - self.ttl
+        )
+
+    def stats(self):
+        total = self.hits + self.misses + self.expired
+        return {
+            'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+
+def stats():
+    """Hit/miss counts of all the caches, for logging"""
+    return {name: c.stats() for name, c in _caches.items()}
@@ -6,6 +6,8 @@ the db, and it will not start from scratch or delete anything.
 
 
 import time
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import os
 
@@ -16,10 +18,58 @@ DATA_DIR = BASE_DIR / 'data'
 # Where does the js server logs its output
 JS_SERVER_LOG_FILE = "/tmp/jsserver.log"
 SOCK_PATH = "/tmp/ipv-spyware"
+NODE_WORKERS = 4  # Number of node servers (server.js) started per store
+APP_BATCH_SIZE = 20  # Apps per call of the <store>_app_batch endpoint of server.js
+APP_BATCH_CONCURRENCY = 4  # Apps of a batch fetched at once by server.js
 SITE_SPECIFIC = ['site:play.google.com', 'site:itunes.apple.com']
 
+# Default locale. A crawl of several locales (--locales) sets the locale of
+# each task with use_locale; always read it with lang() and country().
 LANG =  os.environ.get('APP_LANG', 'en')
 COUNTRY = os.environ.get('APP_COUNTRY', 'us')
+LOCALE_WORKERS = 4  # Number of locales crawled at the same time with --locales
+_locale = threading.local()
+
+
+def lang():
+    """Language of the locale of the current thread"""
+    return getattr(_locale, 'lang', LANG)
+
+
+def country():
+    """Country of the locale of the current thread"""
+    return getattr(_locale, 'country', COUNTRY)
+
+
+def parse_locale(code):
+    """'en_us' -> ('en', 'us')"""
+    lang, _, country = code.strip().partition('_')
+    if not lang or not country:
+        raise ValueError("Locale should be <lang>_<country>, got {!r}".format(code))
+    return lang, country
+
+
+@contextmanager
+def use_locale(lang, country):
+    """Sets the locale of the current thread inside the with block"""
+    old = dict(_locale.__dict__)
+    _locale.lang, _locale.country = lang, country
+    try:
+        yield
+    finally:
+        _locale.__dict__.clear()
+        _locale.__dict__.update(old)
+
+
+def bind_locale(func):
+    """Wraps @func to run with the locale of the calling thread, e.g., when
+    it is handed over to a thread pool"""
+    _lang, _country = lang(), country()
+
+    def _func(*args, **kwargs):
+        with use_locale(_lang, _country):
+            return func(*args, **kwargs)
+    return _func
 
 def now():
     return time.strftime("%Y%m%d:%H%M")
@@ -34,27 +84,80 @@ def timestamp():
 DB_FILE = str(DATA_DIR / "crawled_apps.db")
 TEST_DB_FILE = str(DATA_DIR / "apps_test.db")
 BACKUP_DB = str(DATA_DIR / "apps.db.bak")
+DB_BUSY_TIMEOUT_MS = 30000  # How long a write waits for the other crawler's lock
+DB_SYNCHRONOUS = 'NORMAL'  # Safe with WAL, and much fewer fsyncs than FULL
+DB_LOCK_RETRIES = 8  # Retries (with backoff) of a write that still finds the db locked
+DB_LOCK_MAX_WAIT = 10  # seconds
+TXN_MAX_SECONDS = 30  # Buffered rows are written at least this often
 
 # Download settings
 THROTTLE_DEFAULT = 5   # xx requests per second
+# Starting rate (requests per second) of the rate limiter (ratelimit.py), by
+# endpoint or by store/search engine. Others start at THROTTLE_DEFAULT.
+RATE_LIMITS = {
+    'reviews': 2,  # Google is real angry with reviews
+    'google': 1,
+    'bing': 1,
+    'play': 1,
+}
+RATE_LIMIT_MIN = 0.05  # Never go below one request per 20 seconds
+RATE_LIMIT_MAX = 50
+RATE_LIMIT_INCREASE = 0.1  # Additive increase, req/sec per second of successful requests
+RATE_LIMIT_DECREASE = 0.5  # Multiplicative decrease on errors
+RATE_LIMIT_EMPTY_DECREASE = 0.9  # and on empty responses
+# HTTP requests to the search engines (http_client.py)
+HTTP_TIMEOUT = 10  # seconds
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 1  # seconds, doubles with every retry (with jitter)
+HTTP_BACKOFF_MAX = 60
+HTTP_POOL_SIZE = 16  # keep-alive connections per host
+HTTP_BREAKER_THRESHOLD = 5  # consecutive 429/503s that cut off a host
+HTTP_BREAKER_COOLDOWN = 120  # for these many seconds
+HTTP_ASYNC_WORKERS = 16  # Requests in flight with http_client.aget
+# Tracing of the crawl (tracing.py)
+TRACE_FILE = str(DATA_DIR / 'trace')  # + _<store>.json (chrome trace) / _<store>_summary.json
+TRACE_MAX_SPANS = 200000  # Spans kept for the trace file; the summary counts all
+TRACE_DB = False  # Trace every sqlite statement (db spans) too, see --trace-db
+
+# Profiling with --profile (profiling.py)
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_TOP = 40  # Hotspots in the table
+
+# Metrics of the store calls (metrics.py)
+METRICS_FILE = str(DATA_DIR / 'metrics')  # + _<store>.json / .prom
+METRICS_SNAPSHOT_EVERY = 30  # seconds
+METRICS_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # seconds
+METRICS_PAYLOAD_SAMPLE = 20  # Measure the payload of 1 in N calls per endpoint (0: never)
 APPS_PER_QUERY = 50    # Download 50 apps per search term
 NUM_COMMENTS_TO_DOWNLOAD = 200  # Max 200 comments to download
 # COMMENT_SORT_CRITERIA : NEWEST (defailt) If you need to change that change in server.js
 
+# Large text fields of an app whose changes are tracked by content hash
+TRACKED_TEXT_FIELDS = ['description', 'descriptionHTML', 'recentChanges']
+
+# App refresh scheduling (refresh.py)
+REFRESH_BUDGET = 5000  # Max apps to refresh in one run
+REFRESH_MIN_INTERVAL = 86400  # Do not refetch an app within a day
+REFRESH_DEFAULT_CADENCE = 7 * 86400  # Assume apps change once a week, till we know better
+PROBE_MAX_AGE = 7 * 86400  # Apps with an unchanged listing are still fetched after a week
+EXPORT_CHUNK_SIZE = 50000  # Rows read (and written to parquet) at a time by --export
+UPSERT_BATCH_SIZE = 100  # Rows (apps or terms) buffered before writing them in one transaction
 CLOSURE_SIZE_LIMIT = 1000  # The closure function should giveup after these many points in the set
+CLOSURE_WORKERS = 8  # Number of expansions (RPCs) the closure keeps in flight
+CHECKPOINT_EVERY = 50  # Save the closure state in the db after these many expansions
+SUGGEST_CACHE_TTL = 7 * 86400  # Suggestions of a term are reused for a week
+SIMILAR_CACHE_TTL = 7 * 86400  # and the similar apps of an app
+PERMISSIONS_CACHE_TTL = 90 * 86400  # Permissions of an app version
 
 # Logging
 import logging
 import logging.handlers
+QUERY_FILTER_LOG_LEVEL = logging.DEBUG  # Level at which query_filter logs the blocked queries
+QUERY_FILTER_CACHE_SIZE = 100000  # Max number of queries whose filter score is cached
 _log = None
 LOG_FILENAME = 'appscraper.log'
 LOGGER = 'appscraper'
 
-import numpy as np
-def sleep_time(lam=1.0):
-    """Sample sleeping time from a poisson distribution"""
-    time.sleep(np.random.poisson(lam))
-
 def setup_logger():
     global _log
     if _log is None:
@@ -1,8 +1,14 @@
 # ALL the funcitons above does not check for match in the db
 # db related functions
 import dataset
+import functools
+import hashlib
 import json
-from . import config
+import random
+import time
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from . import config, tracing
 # import sys
 import itertools
 db = None
@@ -16,36 +22,173 @@ def _id_column_type():
         return 'String'
 
 
+def _set_sqlite_pragmas(dbapi_conn, conn_record):
+    """WAL lets the android and ios crawlers (cron.sh) read while the other
+    one writes, and the busy timeout makes a writer wait for the lock instead
+    of failing right away."""
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA busy_timeout={:d}'.format(config.DB_BUSY_TIMEOUT_MS))
+    cur.execute('PRAGMA synchronous={}'.format(config.DB_SYNCHRONOUS))
+    cur.close()
+
+
+def _trace_start(conn, cursor, statement, parameters, context, executemany):
+    # No execution context for the raw DBAPI calls (e.g., some pragmas)
+    if context is None:
+        return
+    context._trace_span = tracing.start(
+        statement.split(None, 1)[0].lower(), 'db', sql=statement[:200])
+
+
+def _trace_finish(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    if getattr(context, '_trace_span', None):
+        tracing.finish(context._trace_span)
+
+
+def _trace_error(exception_context):
+    context = exception_context.execution_context
+    if context is not None and getattr(context, '_trace_span', None):
+        context._trace_span.attrs['error'] = str(exception_context.original_exception)
+        tracing.finish(context._trace_span)
+
+
 def db_connect(test=True):
     global db
     if not db:
         db = dataset.connect(
             'sqlite:///{}'.format(
                 config.TEST_DB_FILE if test else config.DB_FILE
-            )
+            ),
+            engine_kwargs={'connect_args': {
+                'timeout': config.DB_BUSY_TIMEOUT_MS / 1000.0
+            }}
         )
+        # Every (thread local) connection dataset opens gets the pragmas
+        event.listen(db.engine, 'connect', _set_sqlite_pragmas)
+        if config.TRACE_DB:
+            trace_db()
     return db
 
 
+def trace_db():
+    """Makes every statement a `db` span of the crawl trace. Off by default
+    (config.TRACE_DB, --trace-db), since it costs two spans per statement."""
+    config.TRACE_DB = True
+    if db is None:  # db_connect does it
+        return
+    for name, func in [('before_cursor_execute', _trace_start),
+                       ('after_cursor_execute', _trace_finish),
+                       ('handle_error', _trace_error)]:
+        if not event.contains(db.engine, name, func):
+            event.listen(db.engine, name, func)
+
+
+@functools.lru_cache(maxsize=512)
+def _statement(sql):
+    """The text() of @sql, built once. Only :params go in @sql (never the
+    values themselves), so the sql is the same for every call, and sqlite
+    reuses its prepared statement as well."""
+    return text(sql)
+
+
+def query(sql, **params):
+    """db.query of a parameterized @sql, through the statement cache"""
+    return db_connect().query(_statement(sql), **params)
+
+
+def query_many(sql, rows):
+    """Runs the parameterized @sql once per row (dict) of @rows, as one
+    executemany"""
+    return db_connect().executable.execute(_statement(sql), rows)
+
+
+def day_range(day=None):
+    """(start, end) such that start <= time < end for all the times
+    (config.now()) of @day (YYYYMMDD, today by default). A range instead of
+    `time like 'YYYYMMDD%'`, so that the (..., time) indexes are used."""
+    day = day or config.now()[:-5]
+    return day, day + ';'  # ';' comes right after ':' (YYYYMMDD:HHMM)
+
+
+def retry_locked(func, *args, **kwargs):
+    """Calls @func, retrying with jittered exponential backoff as long as
+    sqlite says `database is locked`. @func should be a whole transaction
+    (or a single statement), and not be called inside another transaction."""
+    for attempt in range(config.DB_LOCK_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as e:
+            if 'locked' not in str(e) or attempt == config.DB_LOCK_RETRIES - 1:
+                raise
+            wait = min(config.DB_LOCK_MAX_WAIT, 0.1 * 2 ** attempt) \
+                * random.uniform(0.5, 1.5)
+            logger.info("retry_locked ({}) >> {}, retrying in {:.1f}s".format(
+                getattr(func, '__name__', func), e, wait))
+            with tracing.span('locked', 'wait'):
+                time.sleep(wait)
+
+
+class WriteBuffer(object):
+    """Collects rows and writes them with @write_func (e.g., a function calling
+    upsert_many) in a single transaction, once there are @max_rows rows or
+    @max_seconds passed since the last write. Use it in a `with` block so the
+    remaining rows are written at the end. None rows are ignored.
+    """
+    def __init__(self, write_func, max_rows=None, max_seconds=None):
+        self.write_func = write_func
+        self.max_rows = max_rows or config.UPSERT_BATCH_SIZE
+        self.max_seconds = max_seconds or config.TXN_MAX_SECONDS
+        self.rows = []
+        self.last = time.time()
+
+    def append(self, row):
+        if row is not None:
+            self.rows.append(row)
+        if len(self.rows) >= self.max_rows or \
+           (self.rows and time.time() - self.last >= self.max_seconds):
+            self.flush()
+
+    def _write(self, rows):
+        with db_connect():
+            return self.write_func(rows)
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        self.last = time.time()
+        if rows:
+            return retry_locked(self._write, rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+
 def upsert(tab, data, check_cols, time_check=False):
     """
     Checks in the tab if data[check_cols] already exists, if so, then ignore,
-    else, insert a new row with data. 
+    else, insert a new row with data. Returns True if inserted.
     """
-    _where_str = ' and '.join("{0} = :{0}".format(col) for col in check_cols)
-    _t = data.get('time', config.now()[:-5])
-    _check = data.copy()
+    _where_str = ' and '.join('"{0}" = :{0}'.format(col) for col in check_cols)
+    _check = {col: data.get(col) for col in check_cols}
 
     if time_check:
-        _where_str += " and time like :time"
-        _check['time'] = _t + '%'
+        _where_str += " and time >= :_t0 and time < :_t1"
+        _check['_t0'], _check['_t1'] = day_range(data.get('time', config.now())[:8])
 
     try:
-        res = list(tab.db.query(
+        res = list(tab.db.query(_statement(
             'select 1 from {table} where {where_str} limit 1'.format(
                 table=tab.table.name,
                 where_str=_where_str
-            ), **_check
+            )), **_check
         ))
     except Exception as e:
         print("ERROR (upsert): >> {}".format(e))
@@ -61,6 +204,130 @@ def upsert(tab, data, check_cols, time_check=False):
         print("Inserting app -> {}".format(data.get(check_cols[0])))
         data['time'] = data.get('time', config.now())
         tab.insert(data)
+        return True
+    return False
+
+
+def _row_key(data, cols):
+    return json.dumps([data.get(c) for c in cols], sort_keys=True, default=str)
+
+
+def upsert_many(tab, rows, check_cols, time_check=False):
+    """
+    Batched version of upsert. Checks which of the @rows already exist in
+    @tab (matching on @check_cols) with one set based query per chunk, and
+    inserts the rest in a single transaction.
+    Returns (inserted, skipped) lists of rows.
+    """
+    rows = list(rows)
+    if not rows:
+        return [], []
+    # Each row uses len(check_cols)+1 parameters; sqlite allows 999.
+    chunk_size = max(1, 998 // (len(check_cols) + 1))
+    _t0, _t1 = day_range()
+    found = set()
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        params = {'_t0': _t0, '_t1': _t1} if time_check else {}
+        values = []
+        for j, data in enumerate(chunk):
+            params['i{}'.format(j)] = i + j
+            for k, col in enumerate(check_cols):
+                params['v{}_{}'.format(j, k)] = data.get(col)
+            values.append('(:i{0}, {1})'.format(j, ', '.join(
+                ':v{}_{}'.format(j, k) for k in range(len(check_cols)))))
+        q = 'with _v(_i, {vcols}) as (values {values}) '\
+            'select _i from _v where exists (select 1 from {table} t '\
+            'where {where_str}{timestr})'.format(
+                vcols=', '.join('c{}'.format(k) for k in range(len(check_cols))),
+                values=', '.join(values),
+                table=tab.table.name,
+                where_str=' and '.join('t."{}" = _v.c{}'.format(col, k)
+                                       for k, col in enumerate(check_cols)),
+                timestr=" and t.time >= :_t0 and t.time < :_t1" if time_check else ''
+            )
+        try:
+            found.update(r['_i'] for r in retry_locked(
+                lambda: list(tab.db.query(_statement(q), **params))))
+        except OperationalError as e:
+            # The table or one of the columns does not exist yet: nothing to skip
+            if 'no such' not in str(e):
+                raise
+            logger.info("upsert_many >> {}".format(e))
+
+    inserted, skipped, seen = [], [], set()
+    for i, data in enumerate(rows):
+        key = _row_key(data, check_cols)
+        if i in found or key in seen:
+            skipped.append(data)
+            continue
+        seen.add(key)
+        data['time'] = data.get('time', config.now())
+        inserted.append(data)
+    if inserted:
+        with tab.db:
+            tab.insert_many(inserted)
+    logger.info("upsert_many ({}) >> inserted={} skipped={}".format(
+        tab.name, len(inserted), len(skipped)))
+    return inserted, skipped
+
+
+def insert_or_ignore(tab, rows):
+    """Inserts @rows into @tab, silently skipping the rows whose primary key
+    (or another unique column) is already there. Missing columns are created.
+    Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    columns = []
+    for row in rows:
+        columns.extend(c for c in row if c not in columns)
+    for col in columns:
+        if not tab.has_column(col):
+            example = next((r[col] for r in rows if r.get(col) is not None), '')
+            tab.create_column_by_example(col, example)
+    q = 'insert or ignore into {table} ({cols}) values ({params})'.format(
+        table=tab.table.name,
+        cols=', '.join('"{}"'.format(c) for c in columns),
+        params=', '.join(':p{}'.format(i) for i in range(len(columns)))
+    )
+    params = [
+        {'p{}'.format(i): (json.dumps(r.get(c)) if isinstance(r.get(c), (list, dict))
+                           else r.get(c))
+         for i, c in enumerate(columns)}
+        for r in rows
+    ]
+    res = tab.db.executable.execute(text(q), params)
+    return res.rowcount
+
+
+def save_checkpoint(name, state):
+    """Saves the state (a json serializable dict) of a long running job, e.g.,
+    a query snowball, under @name. Overwrites the previous checkpoint."""
+    table = db_connect().get_table('checkpoints')
+    table.upsert({
+        'name': name,
+        'state': json.dumps(state),
+        'time': config.now()
+    }, ['name'])
+    logger.info("Saved checkpoint {!r}".format(name))
+
+
+def load_checkpoint(name):
+    """Returns the last state saved under @name, or None"""
+    table = db_connect().get_table('checkpoints')
+    row = table.find_one(name=name)
+    if not row:
+        logger.info("No checkpoint found for {!r}".format(name))
+        return None
+    logger.info("Loaded checkpoint {!r} from {}".format(name, row['time']))
+    return json.loads(row['state'])
+
+
+def clear_checkpoint(name):
+    """Removes the checkpoint, once the job is done"""
+    table = db_connect().get_table('checkpoints')
+    table.delete(name=name)
 
 
 def term_table_name(store):
@@ -97,22 +364,319 @@ def desc_table_name(store):
     return store + "_desc"
 
 
+def texts_table_name(store):
+    """Texts table contains every distinct large text (descriptions, release
+    notes, ...) once: hash (primary key), text
+    """
+    return store + "_texts"
+
+
+def desc_history_table_name(store):
+    """Description history contains one row per change of a tracked text field:
+    appId, field, LANG, COUNTRY, hash (of the text in the texts table), time
+    """
+    return desc_table_name(store) + "_history"
+
+
+def desc_latest_table_name(store):
+    """Latest hash of every tracked text field of an app:
+    (appId, field, LANG, COUNTRY) primary key, hash, time
+    """
+    return desc_table_name(store) + "_latest"
+
+
+def text_hash(text):
+    """64 bit integer hash of a text, used to detect changes"""
+    return int.from_bytes(
+        hashlib.sha1(text.encode('utf8')).digest()[:8], 'big', signed=True)
+
+
+_desc_tables_done = set()
+
+
+def ensure_desc_tables(store):
+    """Creates the hash based description tables (if not there)"""
+    if store in _desc_tables_done:
+        return
+    db = db_connect()
+    for q in [
+        'create table if not exists {texts} (hash integer primary key, text text)',
+        'create table if not exists {history} (id integer primary key, '
+        '"appId" text, field text, "LANG" text, "COUNTRY" text, hash integer, time text)',
+        'create index if not exists ix_{history}_app on {history} '
+        '("appId", field, "LANG", "COUNTRY", time)',
+        'create table if not exists {latest} ("appId" text, field text, '
+        '"LANG" text, "COUNTRY" text, hash integer, time text, '
+        'primary key ("appId", field, "LANG", "COUNTRY"))',
+    ]:
+        db.query(q.format(texts=texts_table_name(store),
+                          history=desc_history_table_name(store),
+                          latest=desc_latest_table_name(store)))
+    _desc_tables_done.add(store)
+    # First run after the upgrade: start from the descriptions already seen
+    if not list(db.query('select 1 from {} limit 1'.format(
+            desc_latest_table_name(store)))):
+        migrate_desc_tables(store)
+
+
+def migrate_desc_tables(store, chunk_size=1000):
+    """Backfills the hash based description tables from the old description
+    table (appId, time, description), so that the descriptions we already
+    have are not recorded again as changes. The old table has no locale, its
+    rows get the default one (config.LANG, config.COUNTRY). Safe to run more
+    than once. Returns # descriptions migrated.
+    """
+    ensure_desc_tables(store)
+    db = db_connect()
+    table = db.get_table(desc_table_name(store))
+    if not table.exists or 'description' not in table.columns:
+        return 0
+    names = {'texts': texts_table_name(store),
+             'history': desc_history_table_name(store),
+             'latest': desc_latest_table_name(store)}
+    last, total = -1, 0
+    while True:
+        rows = list(db.query(
+            'select rowid as _rowid, "appId", time, description from {} '
+            'where rowid > :last order by rowid limit :n'.format(table.table.name),
+            last=last, n=chunk_size
+        ))
+        if not rows:
+            break
+        last = rows[-1]['_rowid']
+        params = [{
+            'appid': r['appId'], 'field': 'description', 'lang': config.LANG,
+            'country': config.COUNTRY, 'hash': text_hash(r['description']),
+            'text': r['description'], 'time': r['time']
+        } for r in rows if r['description'] is not None]
+        if not params:
+            continue
+
+        def _write():
+            with db:
+                query_many('insert or ignore into {texts} (hash, text) values '
+                           '(:hash, :text)'.format(**names), params)
+                query_many(
+                    'insert into {history} ("appId", field, "LANG", "COUNTRY", '
+                    'hash, time) select :appid, :field, :lang, :country, :hash, '
+                    ':time where not exists (select 1 from {history} where '
+                    '"appId"=:appid and field=:field and "LANG"=:lang and '
+                    '"COUNTRY"=:country and time=:time)'.format(**names), params)
+        retry_locked(_write)
+        total += len(params)
+        logger.info("migrate_desc_tables ({}) >> {} descriptions so far".format(
+            store, total))
+    # The latest hash of every app is the one of its last history row
+    retry_locked(
+        db.query,
+        'insert or replace into {latest} ("appId", field, "LANG", "COUNTRY", '
+        'hash, time) select "appId", field, "LANG", "COUNTRY", hash, max(time) '
+        'from {history} group by "appId", field, "LANG", "COUNTRY"'.format(**names)
+    )
+    return total
+
+
+def term_apps_table_name(store):
+    """Term-app edge table, one row per app returned for a term search:
+    term, appId, rank (position in the search results), time, LANG, COUNTRY.
+    It is the normalized form of the `apps` column of the term table.
+    """
+    return store + "_term_apps"
+
+
+_term_apps_done = set()
+
+
+def ensure_term_apps_table(store):
+    """Creates the term-app edge table and its indexes (if not there). The
+    first time, the edges of the terms saved before the table existed are
+    backfilled (migrate_term_apps), since the edges are all that is read.
+    """
+    if store in _term_apps_done:
+        return
+    db = db_connect()
+    for q in [
+        'create table if not exists {t} (id integer primary key, term text, '
+        '"appId" text, rank integer, time text, "LANG" text, "COUNTRY" text)',
+        'create unique index if not exists ix_{t}_edge on {t} '
+        '(term, "LANG", "COUNTRY", time, "appId")',
+        'create index if not exists ix_{t}_locale_app on {t} '
+        '("LANG", "COUNTRY", "appId")',
+        'create index if not exists ix_{t}_app on {t} ("appId", time)',
+    ]:
+        db.query(q.format(t=term_apps_table_name(store)))
+    _term_apps_done.add(store)
+    if load_checkpoint(_term_apps_migrated(store)) is None:
+        migrate_term_apps(store)
+
+
+def add_term_apps(store, rows):
+    """Adds the edges of the term rows (as saved in the term table, i.e., with
+    `apps` as a json list) to the term-app table. Returns # edges added.
+    """
+    ensure_term_apps_table(store)
+    edges = []
+    for row in rows:
+        apps = row.get('apps') or []
+        if isinstance(apps, str):
+            apps = json.loads(apps) if apps else []
+        edges.extend({
+            'term': row['term'], 'appId': appid, 'rank': rank,
+            'time': row.get('time'),
+            'LANG': row.get('LANG', row.get('lang')),
+            'COUNTRY': row.get('COUNTRY', row.get('country'))
+        } for rank, appid in enumerate(apps))
+    if not edges:
+        return 0
+    table = db_connect().get_table(term_apps_table_name(store))
+    return insert_or_ignore(table, edges)
+
+
+def _term_apps_migrated(store):
+    """Name of the checkpoint that marks the term-app table as backfilled"""
+    return 'migrate_term_apps_{}'.format(store)
+
+
+def migrate_term_apps(store, chunk_size=1000):
+    """Backfills the term-app table from the json `apps` column of the term
+    table. Safe to run more than once.
+    """
+    ensure_term_apps_table(store)
+    db = db_connect()
+    table = db.get_table(term_table_name(store))
+    if not table.exists:
+        save_checkpoint(_term_apps_migrated(store), {'edges': 0})
+        return 0
+    last, total = -1, 0
+    while True:
+        rows = list(db.query(
+            'select rowid as _rowid, * from {} where rowid > :last '
+            'order by rowid limit :n'.format(table.table.name),
+            last=last, n=chunk_size
+        ))
+        if not rows:
+            break
+        last = rows[-1]['_rowid']
+        try:
+            total += add_term_apps(store, rows)
+        except Exception as e:
+            logger.exception("migrate_term_apps >> {}".format(e))
+        logger.info("migrate_term_apps ({}) >> {} edges so far".format(store, total))
+    save_checkpoint(_term_apps_migrated(store), {'edges': total})
+    return total
+
+
+def get_terms_for_app(store, appid):
+    """Terms (of the current locale) whose search results had @appid"""
+    ensure_term_apps_table(store)
+    return [r['term'] for r in db_connect().query(
+        'select distinct term from {} where "LANG"=:lang and "COUNTRY"=:country '
+        'and "appId"=:appid'.format(term_apps_table_name(store)),
+        lang=config.lang(), country=config.country(), appid=appid
+    )]
+
+
+def get_rank_history(store, appid, term=None):
+    """[(time, term, rank)] of @appid in the search results (of @term)"""
+    ensure_term_apps_table(store)
+    q = 'select time, term, rank from {} where "appId"=:appid '\
+        'and "LANG"=:lang and "COUNTRY"=:country'.format(term_apps_table_name(store))
+    if term is not None:
+        q += ' and term=:term'
+    return [(r['time'], r['term'], r['rank']) for r in db_connect().query(
+        q + ' order by time', appid=appid, term=term,
+        lang=config.lang(), country=config.country()
+    )]
+
+
+def refresh_table_name(store):
+    """Refresh table contains, per appId, LANG and COUNTRY, when the app was
+    fetched and changed last, and how often it changes. See refresh.py
+    """
+    return store + "_refresh"
+
+
+def listings_table_name(store):
+    """Listings table keeps, per appId, LANG and COUNTRY, the hash of the app's
+    search result entry (title, icon, ...), see refresh.record_listings"""
+    return store + "_listings"
+
+
+_listings_done = set()
+
+
+def ensure_listings_table(store):
+    if store in _listings_done:
+        return
+    db_connect().query(
+        'create table if not exists {} ("appId" text, "LANG" text, '
+        '"COUNTRY" text, hash integer, time text, '
+        'primary key ("appId", "LANG", "COUNTRY"))'.format(listings_table_name(store)))
+    _listings_done.add(store)
+
+
+_indexes_done = set()
+
+
+def ensure_indexes(store):
+    """Creates (if not there) the indexes the lookups of the crawl need. The
+    existence checks compare appId/term with COLLATE NOCASE, which can only
+    use an index built with the same collation, and the batched checks
+    (upsert_many) compare them as is, so both are indexed. Tables (or
+    columns) that do not exist yet are skipped, and are indexed by the next
+    call after they get created.
+    """
+    if store in _indexes_done:
+        return
+    db = db_connect()
+    indexes = [
+        # (table, index name, columns)
+        (app_table_name(store), 'appid_nocase', '"appId" COLLATE NOCASE, time'),
+        (app_table_name(store), 'appid_time', '"appId", time'),
+        (term_table_name(store), 'term_nocase', 'term COLLATE NOCASE, time'),
+        (term_table_name(store), 'term_time', 'term, time'),
+        (term_table_name(store), 'locale_term', '"LANG", "COUNTRY", term'),
+        (reviews_table_name(store), 'appid_nocase', '"appId" COLLATE NOCASE'),
+        (refresh_table_name(store), 'locale_app', '"LANG", "COUNTRY", "appId"'),
+    ]
+    if store == 'ios':
+        # exists() compares with COLLATE NOCASE, find_one(iosid=...) as is
+        indexes.append((app_table_name(store), 'iosid_nocase', 'iosid COLLATE NOCASE'))
+        indexes.append((app_table_name(store), 'iosid', 'iosid'))
+    tables = set(db.tables)
+    missing = False
+    for table, name, cols in indexes:
+        if table not in tables:
+            missing = True
+            continue
+        try:
+            retry_locked(db.query, 'create index if not exists ix_{t}_{n} on {t} ({c})'
+                         .format(t=table, n=name, c=cols))
+        except OperationalError as e:  # e.g., no such column (yet)
+            logger.info("ensure_indexes ({}) >> {}".format(table, e))
+            missing = True
+    ensure_term_apps_table(store)
+    ensure_desc_tables(store)
+    if not missing:
+        _indexes_done.add(store)
+
+
 def exists(table, colname, value, time_check=False):
     """Checks if a @value exists in a column @colname in the table @tablename.
     """
-    _t=config.now()[:-5]
-    timecheck_str = "and time like :time" if time_check else ''    
+    _t0, _t1 = day_range()
+    timecheck_str = "and time >= :t0 and time < :t1" if time_check else ''
     if isinstance(table, str):
         table = db_connect().get_table(table)
     try:
-        ret = list(table.db.query(
+        ret = list(table.db.query(_statement(
             "select 1 from {tabname} where {colname}= :value "\
             "COLLATE NOCASE {timestr} "\
             "limit 1"\
                 .format(colname=colname,
                         tabname=table.table.name,
                         timestr=timecheck_str
-                ), value=value, time=_t
+                )), value=value, t0=_t0, t1=_t1
         ))
         if ret:
             return True
@@ -137,17 +701,23 @@ def _get_all_LANG_COUNTRY(table, col):
     """
     if isinstance(table, str):
         table = db_connect().get_table(table)
-    q = 'select {} from {} where LANG==\'{}\' and COUNTRY==\'{}\''.format(col, table.table.name, config.LANG, config.COUNTRY)
-    return [r[col] for r in table.db.query(q)]
+    q = 'select {} from {} where LANG=:lang and COUNTRY=:country'.format(col, table.table.name)
+    return [r[col] for r in table.db.query(_statement(q), lang=config.lang(),
+                                           country=config.country())]
 
 def get_all_appids(store, test):
     """
     Return all the appids found so far in search
     which is the superset of all the apps stored in the android_terms
     """
-    table = term_table_name(store)
     try:
-        return set(itertools.chain(*(json.loads(a) for a in _get_all_LANG_COUNTRY(table, 'apps')))) 
+        # Backfills the edges of the old terms, if not done yet
+        ensure_term_apps_table(store)
+        return set(r['appId'] for r in db_connect().query(
+            'select distinct "appId" from {} where "LANG"=:lang and "COUNTRY"=:country'
+            .format(term_apps_table_name(store)),
+            lang=config.lang(), country=config.country()
+        ))
     except Exception  as e:
         # print(e, file=sys.stderr)
         logger.exception(">> get_all_appids", e)
@@ -0,0 +1,219 @@
+"""
+Exports the crawled tables (apps, terms, descriptions and reviews) to Parquet
+files, partitioned by store/LANG/COUNTRY/crawl_date (reviews by store only),
+for analysis with pandas/arrow/spark without loading the sqlite tables in
+memory.
+
+The tables are read in chunks of config.EXPORT_CHUNK_SIZE rows (by rowid),
+and every chunk is written as soon as it is read. The json columns (e.g.,
+SERIALIZED_KEYS of the app table) are decoded into nested columns. Every
+column has a fixed type (_types, strings unless said otherwise), so that all
+the files of a table read as one dataset. The last exported rowid of each
+table is kept in the `export_state` table, so the next export only writes
+the rows added since.
+
+$ python -m scraper.pyscraper --export data/export --appstore android --prod
+"""
+import json
+import time
+import uuid
+from scraper import config
+from scraper.db_util import (
+    db_connect, app_table_name, term_table_name, reviews_table_name,
+    desc_history_table_name, texts_table_name
+)
+from scraper.appdetails import SERIALIZED_KEYS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for exporting
+    pa = pq = None
+
+logger = config.setup_logger()
+
+PARTITION_COLS = ['store', 'LANG', 'COUNTRY', 'crawl_date']
+# Reviews have no locale nor crawl time of their own
+REVIEW_PARTITION_COLS = ['store']
+
+
+def _closure_to_list(closure):
+    """The `terms` column of the term table is a {term: parent} dict"""
+    return [{'term': k, 'parent': v} for k, v in closure.items()]
+
+
+def _select(table):
+    return 'select rowid as _rowid, * from {} where rowid > :last '\
+           'order by rowid limit :n'.format(table)
+
+
+def _types():
+    """{export name: {column: arrow type}}. The other columns are strings, so
+    that every file of an export has the same schema, whatever values its
+    chunk happened to have (see _to_arrow)."""
+    strings = pa.list_(pa.string())
+    return {
+        'apps': dict({
+            'id': pa.int64(), 'score': pa.float64(), 'price': pa.float64(),
+            'minInstalls': pa.int64(), 'maxInstalls': pa.int64(),
+            'ratings': pa.int64(), 'reviews': pa.int64(),
+            'free': pa.bool_(), 'offersIAP': pa.bool_(), 'adSupported': pa.bool_(),
+            'histogram': pa.map_(pa.string(), pa.int64()),
+        }, **{k: strings for k in [
+            'similar', 'permissions', 'screenshots', 'comments', 'genres',
+            'genreIds', 'languages', 'ipadScreenshots', 'appletvScreenshots',
+            'supportedDevices']}),
+        'terms': {
+            'id': pa.int64(),
+            'terms': pa.list_(pa.struct([('term', pa.string()),
+                                         ('parent', pa.string())])),
+            'apps': strings,
+        },
+        'desc': {'id': pa.int64(), 'hash': pa.int64()},
+        'reviews': {'score': pa.int64(), 'thumbsUp': pa.int64()},
+    }
+
+
+EXPORTS = {
+    # name: (query for a chunk, json columns, special decoders, partition cols)
+    'apps': (lambda store: _select(app_table_name(store)),
+             SERIALIZED_KEYS, {}, PARTITION_COLS),
+    'terms': (lambda store: _select(term_table_name(store)),
+              ['terms', 'apps'], {'terms': _closure_to_list}, PARTITION_COLS),
+    'desc': (lambda store: 'select h.rowid as _rowid, h.*, t.text from {h} h '
+             'left join {t} t on t.hash = h.hash where h.rowid > :last '
+             'order by h.rowid limit :n'.format(
+                 h=desc_history_table_name(store), t=texts_table_name(store)),
+             [], {}, PARTITION_COLS),
+    'reviews': (lambda store: _select(reviews_table_name(store)), [], {},
+                REVIEW_PARTITION_COLS),
+}
+
+
+def _decode(value, decoder=None):
+    if not isinstance(value, str) or not value:
+        return value
+    try:
+        value = json.loads(value)
+    except ValueError:
+        return value
+    if decoder and isinstance(value, dict):
+        value = decoder(value)
+    return value
+
+
+def _to_str(v):
+    return None if v is None else v if isinstance(v, str) else json.dumps(v)
+
+
+def _to_number(cast):
+    def _convert(v):
+        if isinstance(v, str):
+            v = v.replace(',', '').strip()
+        try:
+            return cast(float(v)) if cast is int else cast(v)
+        except (TypeError, ValueError, OverflowError):
+            return None
+    return _convert
+
+
+def _to_bool(v):
+    if isinstance(v, str):
+        return v.lower() in ('1', 'true', 'yes')
+    return None if v is None else bool(v)
+
+
+def _converter(typ):
+    """Converts a (decoded) value to what pa.array of @typ accepts, None if
+    it does not fit"""
+    if pa.types.is_integer(typ):
+        return _to_number(int)
+    if pa.types.is_floating(typ):
+        return _to_number(float)
+    if pa.types.is_boolean(typ):
+        return _to_bool
+    if pa.types.is_map(typ):
+        value = _converter(typ.item_type)
+        return lambda v: [(str(k), value(x)) for k, x in v.items()] \
+            if isinstance(v, dict) else None
+    if pa.types.is_list(typ):
+        item = _converter(typ.value_type)
+        return lambda v: [item(x) for x in v] if isinstance(v, list) else None
+    if pa.types.is_struct(typ):
+        fields = [(f.name, _converter(f.type)) for f in typ]
+        return lambda v: {name: conv(v.get(name)) for name, conv in fields} \
+            if isinstance(v, dict) else None
+    return _to_str
+
+
+def _to_arrow(rows, store, json_cols, decoders, types, partition_cols):
+    """The @rows as an arrow table, every column cast to its type in @types
+    (string if not there)"""
+    today = time.strftime("%Y%m%d")
+    columns = {}
+    for row in rows:
+        for k in row:
+            columns.setdefault(k, None)
+    columns.pop('_rowid', None)
+    data = {}
+    for col in columns:
+        values = [r.get(col) for r in rows]
+        if col in json_cols:
+            values = [_decode(v, decoders.get(col)) for v in values]
+        data[col] = values
+    data['store'] = [store] * len(rows)
+    if 'LANG' in partition_cols:
+        for col, alt in (('LANG', 'lang'), ('COUNTRY', 'country')):
+            data[col] = [r.get(col, r.get(alt)) for r in rows]
+        data['crawl_date'] = [(r.get('time') or today)[:8] for r in rows]
+    arrays, fields = [], []
+    for col, values in data.items():
+        typ = types.get(col, pa.string())
+        convert = _converter(typ)
+        arrays.append(pa.array([convert(v) for v in values], type=typ))
+        fields.append(pa.field(col, typ))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def export_table(name, store, outdir, chunk_size=None):
+    """Exports the rows of the table @name (see EXPORTS) added since the last
+    export to @outdir/@name. Returns the number of rows exported.
+    """
+    query, json_cols, decoders, partition_cols = EXPORTS[name]
+    types = _types()[name]
+    chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+    db = db_connect()
+    state = db.get_table('export_state')
+    key = '{}_{}'.format(store, name)
+    last = (state.find_one(name=key) or {}).get('last_rowid') or 0
+    total = 0
+    while True:
+        try:
+            rows = list(db.query(query(store), last=last, n=chunk_size))
+        except Exception as e:  # table does not exist (yet)
+            logger.info("export_table ({}) >> {}".format(key, e))
+            break
+        if not rows:
+            break
+        pq.write_to_dataset(
+            _to_arrow(rows, store, json_cols, decoders, types, partition_cols),
+            root_path='{}/{}'.format(outdir, name),
+            partition_cols=partition_cols,
+            basename_template=uuid.uuid4().hex + '-{i}.parquet'
+        )
+        last = rows[-1]['_rowid']
+        total += len(rows)
+        state.upsert({'name': key, 'last_rowid': last, 'time': config.now()},
+                     ['name'])
+        logger.info("export_table ({}) >> {} rows".format(key, total))
+    return total
+
+
+def export_all(store, outdir, tables=None):
+    """Exports all (or the given) tables of the @store. Returns {table: #rows}"""
+    if pa is None:
+        raise ImportError("Exporting needs pyarrow: pip install pyarrow")
+    return {
+        name: export_table(name, store, outdir)
+        for name in (tables or EXPORTS)
+    }
@@ -0,0 +1,183 @@
+"""
+A local stand-in for server.js, for benchmarking the crawl without hitting
+Google or Apple. It implements the same `<store>_<api>` methods over zerorpc
+and returns synthetic (but deterministic) apps, suggestions, similar apps and
+review pages, after a configurable latency. A fraction of the calls fail
+the way server.js fails, by returning [].
+
+$ python -m scraper.fake_store android /tmp/fake_android_0.sock --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import random
+import time
+import zlib
+import gevent
+import gevent.pool
+import zerorpc
+
+WORDS = ['tracker', 'spy', 'phone', 'location', 'family', 'monitor', 'find',
+         'locate', 'parental', 'sms', 'secret', 'hidden', 'gps', 'app']
+REVIEWS_PER_PAGE = 40
+
+
+def _h(*args):
+    return zlib.crc32('|'.join(str(a) for a in args).encode('utf8'))
+
+
+class FakeStore(object):
+    def __init__(self, store, latency=0.05, error_rate=0.0, num_apps=5000,
+                 seed=0):
+        self.store = store
+        self.latency = latency
+        self.error_rate = error_rate
+        self.num_apps = num_apps
+        self.random = random.Random(seed)
+        # The methods exposed over zerorpc, same names as in server.js
+        self.methods = {
+            '{}_{}'.format(store, api): self._api(api)
+            for api in ('app', 'list', 'search', 'suggest', 'similar',
+                        'reviews', 'permissions', 'developer')
+        }
+        self.methods['{}_app_batch'.format(store)] = zerorpc.stream(self._app_batch)
+
+    def _api(self, name):
+        func = getattr(self, '_' + name)
+
+        def _call(query):
+            # cooperative sleep, so concurrent requests overlap like in node
+            gevent.sleep(self.random.expovariate(1.0 / self.latency)
+                         if self.latency > 0 else 0)
+            if self.random.random() < self.error_rate:
+                return []
+            return func(query)
+        return _call
+
+    def _app_batch(self, batch):
+        # Like server.js: the queries run `concurrency` at a time, and are
+        # streamed back as they finish. A failed query (or a gone app)
+        # comes back with ok=False.
+        queries = batch.get('queries', [])
+        app = self.methods['{}_app'.format(self.store)]
+
+        def _run(i):
+            t = time.time()
+            ret = app(queries[i])
+            item = {'i': i, 'appId': queries[i].get('appId') or str(queries[i].get('id')),
+                    'ok': bool(ret), 'ms': int((time.time() - t) * 1000)}
+            if ret:
+                item['result'] = ret
+            else:
+                item['error'] = 'App not found (404)'
+            return item
+        pool = gevent.pool.Pool(batch.get('concurrency') or 4)
+        return pool.imap_unordered(_run, range(len(queries)))
+
+    def _appid(self, i):
+        return 'com.fake.app{}'.format(i % self.num_apps)
+
+    def _app_summary(self, appid):
+        i = _h(appid)
+        return {
+            'appId': appid,
+            'title': 'Fake app {}'.format(appid.rsplit('.', 1)[-1]),
+            'developer': 'Developer {}'.format(i % 500),
+            'icon': 'https://example.com/{}.png'.format(appid),
+            'score': (i % 50) / 10.0,
+            'price': 0,
+            'free': True,
+        }
+
+    def _app(self, query):
+        appid = query.get('appId') or 'com.fake.app{}'.format(query.get('id'))
+        i = _h(appid)
+        if i % 97 == 0:  # Some apps are gone from the store
+            return []
+        ret = self._app_summary(appid)
+        # About a tenth of the apps get updated every day
+        day = int(time.time() // 86400)
+        version = day - (i + day) % 10
+        ret.update({
+            'url': 'https://example.com/app/{}'.format(appid),
+            'description': ' '.join(WORDS[(i + k) % len(WORDS)] for k in range(300)),
+            'descriptionHTML': '<p>{}</p>'.format(' '.join(WORDS) * 20),
+            'summary': 'Summary of {}'.format(appid),
+            'version': '1.{}'.format(version),
+            'updated': version * 86400,
+            'reviews': i % 1000,
+            'minInstalls': 10 ** (i % 7),
+            'screenshots': ['https://example.com/{}/{}.png'.format(appid, k)
+                            for k in range(8)],
+            'histogram': {str(k): (i >> k) % 100 for k in range(1, 6)},
+            'recentChanges': 'Version 1.{}'.format(version),
+            'genre': 'Tools',
+        })
+        if self.store == 'ios':
+            ret['id'] = i
+        return ret
+
+    def _list(self, query):
+        n = query.get('num', 50)
+        return [self._app_summary(self._appid(k)) for k in range(n)]
+
+    def _search(self, query):
+        i = _h(query.get('term'))
+        return [self._app_summary(self._appid(i + k * 7919))
+                for k in range(query.get('num', 50))]
+
+    def _suggest(self, query):
+        term = query.get('term', '')
+        i = _h(term)
+        sugg = ['{} {}'.format(term, WORDS[(i + k) % len(WORDS)]).strip()
+                for k in range(5)]
+        if self.store == 'ios':
+            return [{'term': t} for t in sugg]
+        return sugg
+
+    def _similar(self, query):
+        i = _h(query.get('appId'))
+        return [self._app_summary(self._appid(i + k * 104729)) for k in range(20)]
+
+    def _reviews(self, query):
+        appid = query.get('appId') or query.get('id')
+        total = _h(appid) % 1000
+        page = query.get('page', 0)
+        return [{
+            'id': 'gp:{}:{}'.format(appid, k),
+            'userName': 'user{}'.format(k),
+            'date': 'January 1, 2020',
+            'score': k % 5 + 1,
+            'title': 'Review {}'.format(k),
+            'text': 'This app is a fake app. ' * (k % 20 + 1),
+        } for k in range(page * REVIEWS_PER_PAGE,
+                         min(total, (page + 1) * REVIEWS_PER_PAGE))]
+
+    def _permissions(self, query):
+        i = _h(query.get('appId'))
+        perms = ['access location', 'read sms', 'camera', 'microphone',
+                 'read contacts', 'full network access']
+        return [p for k, p in enumerate(perms) if (i >> k) & 1]
+
+    def _developer(self, query):
+        return self._list({'num': 10})
+
+
+def serve(store, sock_path, **kwargs):
+    server = zerorpc.Server(FakeStore(store, **kwargs).methods)
+    server.bind('ipc://{}'.format(sock_path))
+    print("Fake {} store listening on {}".format(store, sock_path))
+    server.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake server.js for benchmarks")
+    parser.add_argument('store', choices=['android', 'ios'])
+    parser.add_argument('sock_path')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Mean latency of a call in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of the calls that return []")
+    parser.add_argument('--num-apps', type=int, default=5000,
+                        help="Size of the fake app catalog")
+    args = parser.parse_args()
+    serve(args.store, args.sock_path, latency=args.latency,
+          error_rate=args.error_rate, num_apps=args.num_apps)
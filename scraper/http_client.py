@@ -0,0 +1,148 @@
+"""
+Shared HTTP client for the search engines (and the play store pages). Every
+host gets one keep-alive requests.Session with a pool of connections, and
+every request goes through the rate limiter (ratelimit.py), with a timeout,
+and retries with jittered exponential backoff on connection errors and 5xx.
+
+A host that keeps answering 429/503 is cut off (circuit breaker) for
+config.HTTP_BREAKER_COOLDOWN seconds (or its Retry-After): requests to it
+fail right away with CircuitOpen instead of piling up more throttling.
+
+    r = http_client.get(url, 'google', 'complete', timeout=2)
+    # or, from asyncio code
+    r = await http_client.aget(url, 'google', 'complete')
+"""
+import asyncio
+import functools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from scraper import config, ratelimit, tracing
+
+logger = config.setup_logger()
+
+THROTTLED = (429, 503)
+
+
+class CircuitOpen(requests.RequestException):
+    """The host is cut off for a while after too many 429/503s"""
+
+
+class _Breaker(object):
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        if time.time() < self.open_until:
+            raise CircuitOpen("{} is throttling us, retry after {:.0f} sec"
+                              .format(self.host, self.open_until - time.time()))
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            if self.failures < config.HTTP_BREAKER_THRESHOLD:
+                return
+            self.failures = 0
+            self.open_until = time.time() + max(
+                retry_after or 0, config.HTTP_BREAKER_COOLDOWN)
+        logger.warning("http_client: circuit open for {} till {}".format(
+            self.host, time.ctime(self.open_until)))
+
+
+_sessions = {}
+_breakers = {}
+_lock = threading.Lock()
+
+
+def _get_host(host):
+    """(session, breaker) of the @host"""
+    with _lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=config.HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _sessions[host] = session
+            _breakers[host] = _Breaker(host)
+        return _sessions[host], _breakers[host]
+
+
+def _retry_after(r):
+    try:
+        return float(r.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff(attempt):
+    """Full jitter: uniform in [0, min(max, base * 2^attempt)]"""
+    return random.uniform(0, min(config.HTTP_BACKOFF_MAX,
+                                 config.HTTP_BACKOFF * 2 ** attempt))
+
+
+def get(url, engine, endpoint, locale=None, timeout=None, retries=None, **kwargs):
+    """GET @url through the rate limiter of (@engine, @endpoint, @locale).
+    Returns the response; after @retries (config.HTTP_RETRIES) failed
+    attempts, the last (not ok) response, or raises the last exception.
+    """
+    timeout = config.HTTP_TIMEOUT if timeout is None else timeout
+    retries = config.HTTP_RETRIES if retries is None else retries
+    host = urlparse(url).netloc
+    session, breaker = _get_host(host)
+    r = error = None
+    for attempt in range(retries + 1):
+        breaker.check()
+        with tracing.span('ratelimit', 'wait'):
+            ratelimit.acquire(engine, endpoint, locale=locale)
+        try:
+            with tracing.span('{}_{}'.format(engine, endpoint), 'rpc', host=host):
+                r, error = session.get(url, timeout=timeout, **kwargs), None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            r, error = None, e
+            ratelimit.report(engine, endpoint, ratelimit.ERROR, locale=locale)
+        else:
+            if r.status_code in THROTTLED:
+                breaker.failure(_retry_after(r))
+            if r.status_code in THROTTLED or r.status_code >= 500:
+                ratelimit.report(engine, endpoint, ratelimit.ERROR, locale=locale)
+            else:
+                breaker.success()
+                ratelimit.report(engine, endpoint, ratelimit.OK, locale=locale)
+                return r
+        if attempt < retries:
+            wait = _backoff(attempt)
+            logger.info("http_client: {} for {}, retrying in {:.1f} sec".format(
+                error or r.status_code, url, wait))
+            with tracing.span('backoff', 'wait'):
+                time.sleep(wait)
+    if error is not None:
+        raise error
+    return r
+
+
+_executor = None
+
+
+async def aget(url, engine, endpoint, **kwargs):
+    """asyncio version of get, the request runs in a pool of
+    config.HTTP_ASYNC_WORKERS threads."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.HTTP_ASYNC_WORKERS)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor, functools.partial(get, url, engine, endpoint, **kwargs))
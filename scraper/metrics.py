@@ -0,0 +1,161 @@
+"""
+Metrics of the store calls (see appstore_api.get_store_func), per (store,
+endpoint): number of calls, ok/empty/error results, a latency histogram and
+the payload size (msgpack bytes, as sent by server.js). Encoding a result
+again only to measure it is not free, so the payload of only 1 in
+config.METRICS_PAYLOAD_SAMPLE calls is measured, and the total is estimated
+from those.
+
+A snapshot of the metrics is written every config.METRICS_SNAPSHOT_EVERY
+seconds during the run (and at exit) to <config.METRICS_FILE>_<store>.json,
+and in the prometheus text format to ....prom (e.g., for node_exporter's
+textfile collector):
+
+    $ watch cat data/metrics_android.prom
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import msgpack
+from scraper import config
+
+logger = config.setup_logger()
+
+OK = 'ok'
+EMPTY = 'empty'
+ERROR = 'error'
+
+
+class EndpointMetrics(object):
+    def __init__(self):
+        self.results = {OK: 0, EMPTY: 0, ERROR: 0}
+        self.buckets = [0] * len(config.METRICS_LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.payload_bytes = 0
+        self.payload_max = 0
+        self.payload_sampled = 0
+
+    @property
+    def calls(self):
+        return sum(self.results.values())
+
+    def record(self, latency, status, nbytes=None):
+        """@nbytes is the payload size of a sampled call, None otherwise"""
+        self.results[status] += 1
+        self.latency_sum += latency
+        for i, le in enumerate(config.METRICS_LATENCY_BUCKETS):
+            if latency <= le:
+                self.buckets[i] += 1
+                break
+        if nbytes is not None:
+            self.payload_sampled += 1
+            # Stands for the calls that were not sampled
+            self.payload_bytes += nbytes * config.METRICS_PAYLOAD_SAMPLE
+            self.payload_max = max(self.payload_max, nbytes)
+
+    def to_dict(self):
+        calls = self.calls
+        return {
+            'calls': calls,
+            'results': dict(self.results),
+            'latency_sum': round(self.latency_sum, 3),
+            'latency_avg': round(self.latency_sum / calls, 4) if calls else 0.0,
+            'latency_buckets': dict(zip(
+                (str(le) for le in config.METRICS_LATENCY_BUCKETS), self.buckets)),
+            'payload_bytes': self.payload_bytes,
+            'payload_max': self.payload_max,
+            'payload_sampled': self.payload_sampled,
+        }
+
+
+_metrics = {}  # (store, endpoint): EndpointMetrics
+_lock = threading.Lock()
+_last_snapshot = [time.time()]
+
+
+def _payload_size(result):
+    try:
+        return len(msgpack.packb(result, use_bin_type=True, default=str))
+    except Exception:
+        return 0
+
+
+def record(store, endpoint, latency, result=None, error=False):
+    """Records a call of @store's @endpoint that took @latency seconds and
+    returned @result (or raised, if @error)"""
+    status = ERROR if error else OK if result else EMPTY
+    key = (store, endpoint)
+    with _lock:
+        if key not in _metrics:
+            _metrics[key] = EndpointMetrics()
+        sample = config.METRICS_PAYLOAD_SAMPLE and not error and \
+            _metrics[key].calls % config.METRICS_PAYLOAD_SAMPLE == 0
+    # Encoded outside of the lock, the other threads do not wait for it
+    nbytes = _payload_size(result) if sample else None
+    with _lock:
+        _metrics[key].record(latency, status, nbytes)
+        due = time.time() - _last_snapshot[0] >= config.METRICS_SNAPSHOT_EVERY
+        if due:
+            _last_snapshot[0] = time.time()
+    if due:
+        snapshot()
+
+
+def get_metrics():
+    """{'<store>_<endpoint>': metrics dict}"""
+    with _lock:
+        return {'{}_{}'.format(*k): m.to_dict() for k, m in sorted(_metrics.items())}
+
+
+def to_prometheus():
+    """The metrics in the prometheus text exposition format"""
+    calls, hist, payload = [], [], []
+    with _lock:
+        for (store, endpoint), m in sorted(_metrics.items()):
+            labels = 'store="{}",endpoint="{}"'.format(store, endpoint)
+            for status, n in sorted(m.results.items()):
+                calls.append('appscraper_store_calls_total{{{},result="{}"}} {}'
+                             .format(labels, status, n))
+            cum = 0
+            for le, n in zip(config.METRICS_LATENCY_BUCKETS, m.buckets):
+                cum += n
+                hist.append('appscraper_store_latency_seconds_bucket{{{},le="{}"}} {}'
+                            .format(labels, le, cum))
+            hist.append('appscraper_store_latency_seconds_bucket{{{},le="+Inf"}} {}'
+                        .format(labels, m.calls))
+            hist.append('appscraper_store_latency_seconds_sum{{{}}} {:.6f}'
+                        .format(labels, m.latency_sum))
+            hist.append('appscraper_store_latency_seconds_count{{{}}} {}'
+                        .format(labels, m.calls))
+            payload.append('appscraper_store_payload_bytes_total{{{}}} {}'
+                           .format(labels, m.payload_bytes))
+    lines = ['# TYPE appscraper_store_calls_total counter'] + calls + \
+        ['# TYPE appscraper_store_latency_seconds histogram'] + hist + \
+        ['# TYPE appscraper_store_payload_bytes_total counter'] + payload
+    return '\n'.join(lines) + '\n'
+
+
+def _write(fname, content):
+    with open(fname + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(fname + '.tmp', fname)
+
+
+def snapshot(path=None):
+    """Writes the metrics to @path.json and @path.prom. @path defaults to
+    <config.METRICS_FILE>_<stores>."""
+    with _lock:
+        stores = sorted(set(s for s, _ in _metrics))
+    if not stores:
+        return
+    path = path or '{}_{}'.format(config.METRICS_FILE, '_'.join(stores))
+    try:
+        _write(path + '.json', json.dumps(get_metrics(), indent=2))
+        _write(path + '.prom', to_prometheus())
+    except (IOError, OSError) as e:
+        logger.info("metrics.snapshot >> {}".format(e))
+
+
+atexit.register(snapshot)
@@ -8,8 +8,11 @@ from urllib.parse import urlparse, parse_qs
 from pathlib import Path
 import json
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
+MANIFEST_SAVE_EVERY = 500  # pages
+
 QUERY_RELEVANCE = None
 
 def isrelevant(fname):
@@ -86,6 +89,65 @@ def collect_all_pages(dirname):
         json.dump(D, f, indent=2);
 
 
+def _parse_file(fpath):
+    """parse_page of one file, as a json line. Runs in the worker processes."""
+    ret = {'page': fpath.name.rsplit('.', 1)[0], 'path': str(fpath)}
+    try:
+        with fpath.open('rb') as f:
+            links, suggestions, ads = parse_page(f)
+        ret.update({'links': links, 'suggestions': suggestions, 'ads': ads})
+    except Exception as e:
+        ret['error'] = repr(e)
+    return json.dumps(ret)
+
+
+def _save_manifest(manifest, fname):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def collect_all_pages_parallel(dirname, workers=None, outfile=None):
+    """Parallel and incremental version of collect_all_pages. The pages are
+    parsed by a pool of @workers processes, and each result is appended to
+    `parsed_@dirname.jsonl` (or @outfile) as soon as it is ready, one page
+    per line: {page, path, links, suggestions, ads} (or {page, path, error}).
+
+    A manifest (@outfile.manifest) keeps the (mtime, size) of every parsed
+    file; files that did not change since are skipped in the next run. A
+    page that changed is appended again, so the last line of a page wins.
+    Returns the number of pages parsed.
+    """
+    outfile = outfile or 'parsed_{}.jsonl'.format(Path(dirname).name)
+    manifest_f = outfile + '.manifest'
+    manifest = {}
+    if os.path.exists(manifest_f):
+        with open(manifest_f) as f:
+            manifest = json.load(f)
+
+    todo, unchanged = [], 0
+    for fpath in Path(dirname).glob('**/*.html'):
+        st = fpath.stat()
+        if manifest.get(str(fpath)) == [st.st_mtime, st.st_size]:
+            unchanged += 1
+        else:
+            todo.append((fpath, [st.st_mtime, st.st_size]))
+    print("{} pages to parse, {} unchanged".format(len(todo), unchanged))
+
+    with open(outfile, 'a') as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_parse_file, [p for p, _ in todo], chunksize=16)
+        for i, ((fpath, stat), line) in enumerate(zip(todo, results)):
+            f.write(line + '\n')
+            manifest[str(fpath)] = stat
+            if (i + 1) % MANIFEST_SAVE_EVERY == 0:
+                f.flush()
+                _save_manifest(manifest, manifest_f)
+                print(i + 1, fpath)
+        f.flush()
+        _save_manifest(manifest, manifest_f)
+    return len(todo)
+
+
 def prune_lists(json_db):
     """Read the json file created by collect_all_pages function and prune the lists
     based on some heuristics, then, get the pages and look for android in them. 
@@ -104,7 +166,10 @@ def prune_lists(json_db):
 
 
 if __name__ == "__main__":
-    if os.path.isdir(sys.argv[1]):
+    # $ python parse_google.py <dir> [<workers>]
+    if os.path.isdir(sys.argv[1]) and len(sys.argv) > 2:
+        collect_all_pages_parallel(sys.argv[1], workers=int(sys.argv[2]))
+    elif os.path.isdir(sys.argv[1]):
         collect_all_pages(sys.argv[1])
     else:
          print(json.dumps(parse_page(open(sys.argv[1])), indent=4))
@@ -0,0 +1,177 @@
+"""
+Profiling of pyscraper runs (--profile), to find the python side overheads
+(json, query filtering, sql building, ...) without instrumenting the code.
+
+Two modes:
+    cprofile: deterministic, with cProfile. Only sees the thread that runs
+              the action (not the closure/locale thread pools).
+    sample:   samples the stacks of all the threads every
+              config.PROFILE_INTERVAL seconds (sys._current_frames).
+
+Both write a top-N table of hotspots to <out>.txt, and a collapsed-stack
+file to <out>.collapsed (one `frame;frame;... count` per line) for
+flamegraph.pl or speedscope. cprofile also dumps the pstats to <out>.prof.
+Its stacks are only caller;callee pairs, since cProfile does not keep full
+stacks.
+
+By default the time blocked in zerorpc/gevent/zmq (waiting on server.js) and
+in idle pool threads is left out (ignore_io), so that what remains is the
+time python spends itself.
+
+$ python -m scraper.pyscraper --crawl --appstore android --profile sample
+"""
+import collections
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from scraper import config
+
+logger = config.setup_logger()
+
+IO_MODULES = ('zerorpc', 'gevent', 'zmq')
+# A thread whose innermost frame is in one of these is blocked, not working
+IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py', 'thread.py')
+
+
+def _frame_name(code):
+    return '{}:{}'.format(
+        os.path.basename(code.co_filename).rsplit('.', 1)[0], code.co_name)
+
+
+def _is_io(filename, func=''):
+    """Is it a frame (or a cProfile entry) that waits for I/O or a lock"""
+    parts = filename.replace('\\', '/').split('/')
+    return any(m in parts for m in IO_MODULES) or '_thread.lock' in func
+
+
+class Sampler(object):
+    """Samples the stacks of all the other threads every @interval seconds"""
+
+    def __init__(self, interval=None, ignore_io=True):
+        self.interval = interval or config.PROFILE_INTERVAL
+        self.ignore_io = ignore_io
+        self.stacks = collections.Counter()
+        self.samples = self.ignored = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler')
+        self._thread.daemon = True
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                self.samples += 1
+                if self.ignore_io and (
+                        os.path.basename(frame.f_code.co_filename) in IDLE_FILES):
+                    self.ignored += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    if self.ignore_io and _is_io(frame.f_code.co_filename):
+                        stack = None
+                        break
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack is None:
+                    self.ignored += 1
+                    continue
+                stack.append(names.get(tid, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self, n):
+        """[(function, self samples, total samples)] of the @n hottest"""
+        own, total = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]  # without the thread name
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for f in set(frames):
+                total[f] += count
+        return [(f, c, total[f]) for f, c in own.most_common(n)]
+
+    def write(self, out, n):
+        with open(out + '.collapsed', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        kept = max(self.samples - self.ignored, 1)
+        with open(out + '.txt', 'w') as f:
+            f.write("{} samples every {} sec, {} ignored (io/idle)\n\n".format(
+                self.samples, self.interval, self.ignored))
+            f.write("{:>8s} {:>8s}  {}\n".format('self%', 'total%', 'function'))
+            for func, own, total in self.top(n):
+                f.write("{:>7.1%} {:>7.1%}  {}\n".format(
+                    own / kept, total / kept, func))
+
+
+def _write_cprofile(prof, out, n, ignore_io):
+    prof.dump_stats(out + '.prof')
+    stats = pstats.Stats(prof)
+    collapsed = collections.Counter()
+    for (filename, _, func), (_, _, tottime, _, callers) in stats.stats.items():
+        if ignore_io and _is_io(filename, func):
+            continue
+        callee = '{}:{}'.format(os.path.basename(filename).rsplit('.', 1)[0], func)
+        for (cfile, _, cfunc), (_, _, ctottime, _) in callers.items():
+            caller = '{}:{}'.format(os.path.basename(cfile).rsplit('.', 1)[0], cfunc)
+            collapsed['{};{}'.format(caller, callee)] += int(ctottime * 1e6)
+        if not callers:
+            collapsed[callee] += int(tottime * 1e6)
+    with open(out + '.collapsed', 'w') as f:
+        for stack, usec in collapsed.most_common():
+            if usec:
+                f.write('{} {}\n'.format(stack, usec))
+    s = io.StringIO()
+    stats = pstats.Stats(prof, stream=s).sort_stats('tottime')
+    if ignore_io:
+        stats.print_stats(r'^(?!.*({}|_thread\.lock)).*$'.format('|'.join(IO_MODULES)), n)
+    else:
+        stats.print_stats(n)
+    with open(out + '.txt', 'w') as f:
+        f.write(s.getvalue())
+
+
+def run(func, args=(), mode='sample', out=None, top=None, ignore_io=True):
+    """Runs func(*@args) under the profiler (@mode: 'cprofile' or 'sample'),
+    and writes the results to @out.{txt,collapsed}. Returns what func
+    returned."""
+    out = out or str(config.DATA_DIR / 'profile')
+    top = top or config.PROFILE_TOP
+    t = time.time()
+    if mode == 'cprofile':
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(func, *args)
+        finally:
+            _write_cprofile(prof, out, top, ignore_io)
+            logger.info("Profile ({:.0f} sec) saved to {}.txt and {}.collapsed"
+                        .format(time.time() - t, out, out))
+    elif mode == 'sample':
+        sampler = Sampler(ignore_io=ignore_io)
+        sampler.start()
+        try:
+            return func(*args)
+        finally:
+            sampler.stop()
+            sampler.write(out, top)
+            logger.info("Profile ({:.0f} sec, {} samples) saved to {}.txt and "
+                        "{}.collapsed".format(time.time() - t, sampler.samples,
+                                              out, out))
+    else:
+        raise ValueError("Unknown profile mode: {!r}".format(mode))
@@ -18,18 +18,30 @@ import sys
 import dataset
 import json
 import copy
+import threading
 from collections import Counter
-from scraper import config, queries
-from scraper.query_filter import should_allow
+from concurrent.futures import ThreadPoolExecutor
+from scraper import config, queries, ratelimit, cache, tracing
+from scraper.query_filter import should_allow, rule_hits
 import argparse
 from scraper.appstore_api import get_store_func, app_page, connect
 from scraper.db_util import (
-    db_connect, upsert, term_table_name, app_table_name, reviews_table_name,
+    db_connect, upsert, upsert_many, term_table_name, app_table_name, reviews_table_name,
     desc_table_name, exists, get_all_appids, _id_column_type, get_all_terms,
-    get_all_terms_LANG_COUNTRY
+    get_all_terms_LANG_COUNTRY, save_checkpoint, load_checkpoint,
+    clear_checkpoint, add_term_apps, migrate_term_apps, migrate_desc_tables,
+    WriteBuffer, query,
+    ensure_indexes, trace_db
 )
 from scraper.search_engines import get_term_expansion
-from scraper.appdetails import download_app_details, download_reviews, get_similar_apps
+from scraper.refresh import (
+    next_refresh_batch, record_listings, stage_counts, save_fetches,
+)
+from scraper.appdetails import (
+    download_app_details, fetch_app_details, fetch_app_details_batches,
+    save_app_details, download_reviews,
+    iter_reviews, get_similar_apps, update_desc_table
+)
 from collections import OrderedDict, deque
 from dateutil import parser as dateparser
 import pandas as pd
@@ -38,26 +50,86 @@ logger = config.setup_logger()
 missed_items_file = open('missed_items', 'a')
 
 
-def get_operation_closure(op_func, start_nodes, limit=1000, black_list=None):
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    """Thread pools are kept around between closures, so that the per-thread
+    zerorpc clients are reused as well."""
+    with _executors_lock:
+        if workers not in _executors:
+            _executors[workers] = ThreadPoolExecutor(max_workers=workers)
+        return _executors[workers]
+
+
+class _Inline(object):
+    """Stand-in for a future when op_func is run without a thread pool."""
+    def __init__(self, func, arg):
+        self.func, self.arg = func, arg
+
+    def result(self):
+        return self.func(self.arg)
+
+    def cancel(self):
+        return True
+
+
+def get_operation_closure(op_func, start_nodes, limit=1000, black_list=None,
+                          workers=1, state=None, checkpoint=None,
+                          checkpoint_every=config.CHECKPOINT_EVERY, graph=None):
     """
     Given a similarity function op_func and a start point start_node, returns
     the closure of the start_node. By closure I meant, a set which is closed
     under the operation op_func and contains start_node.
+
+    Upto @workers calls to op_func are kept in flight at a time. The results
+    are consumed in the same order the nodes are picked from the frontier, so
+    the returned closure (and the parent of each node) is the same as with
+    workers=1. A few extra calls may be wasted once the limit is hit.
+
+    If @checkpoint is given, it is called with the current state (closure,
+    parents and pending frontier) every @checkpoint_every expansions. Passing
+    such a state back as @state continues the closure from that point.
+
+    If @graph (a dict) is given, the result of every op_func call is
+    recorded in it, {node: op_func(node)}, and saved with the checkpoints.
     :return: Retunrs closure and the level information
     """
     if not isinstance(start_nodes, (list, set)):
         start_nodes = [start_nodes]
+    if workers > 1:
+        submit = _get_executor(workers).submit
+        op_func = tracing.bind(config.bind_locale(op_func))
+    else:
+        submit = _Inline
     parent = ''
     unchecked = {n: parent for n in start_nodes}
     _unchecked_list = deque(unchecked.keys())
     closure = {n: parent for n in start_nodes}
-    while _unchecked_list and len(closure) < limit:
-        node = _unchecked_list.popleft()
-        parent = unchecked[node]
-        if black_list and black_list(node):
-            logger.info("Filtered query: {!r}".format(node))
+    if state:
+        closure, unchecked = state['closure'], state['parents']
+        _unchecked_list = deque(state['pending'])
+        if graph is not None:
+            graph.update(state.get('graph') or {})
+        logger.info("Resuming closure: done={}, pending={}".format(
+            len(closure), len(_unchecked_list)))
+    in_flight = deque()  # (node, future) in the order they were picked
+    expansions = 0
+    while (_unchecked_list or in_flight) and len(closure) < limit:
+        while _unchecked_list and len(in_flight) < max(workers, 1):
+            node = _unchecked_list.popleft()
+            if black_list and black_list(node):
+                logger.info("Filtered query: {!r}".format(node))
+                continue
+            in_flight.append((node, submit(op_func, node)))
+        if not in_flight:
             continue
-        for n in op_func(node):
+        node, future = in_flight.popleft()
+        result = future.result()
+        if graph is not None:
+            graph[node] = list(result)
+        for n in result:
             if n not in unchecked:
                 unchecked[n] = node  # node is the parent of n
                 _unchecked_list.append(n)
@@ -66,7 +138,17 @@ def get_operation_closure(op_func, start_nodes, limit=1000, black_list=None):
             #                   if n not in closure and n not in unchecked})
         if len(closure) % 10 == 0:
             logger.info("Done={:3d},\t\tremaining={:3d}"
-                  .format(len(closure), len(_unchecked_list)))
+                  .format(len(closure), len(_unchecked_list) + len(in_flight)))
+        expansions += 1
+        if checkpoint and expansions % checkpoint_every == 0:
+            checkpoint({
+                'closure': closure,
+                'parents': unchecked,
+                'pending': [n for n, _ in in_flight] + list(_unchecked_list),
+                'graph': graph
+            })
+    for _, future in in_flight:
+        future.cancel()
     if len(closure) >= limit:
         logger.info("Hit the maximum allowed limit of calls!!"
               "len(closure)={}\nUnchecked ({}): {}".format(
@@ -77,10 +159,21 @@ def get_operation_closure(op_func, start_nodes, limit=1000, black_list=None):
     return closure
 
 
+suggest_cache = cache.TTLCache('suggest', config.SUGGEST_CACHE_TTL)
+
+
 def get_term_completions(term, store):
     """
-    Get term completion suggestions for a term
+    Get term completion suggestions for a term. The suggestions are cached
+    (see suggest_cache) for config.SUGGEST_CACHE_TTL seconds.
     """
+    return suggest_cache.get_or_compute(
+        (store, term, config.lang(), config.country()),
+        lambda: _get_term_completions(term, store)
+    )
+
+
+def _get_term_completions(term, store):
     if store == 'android':
         _t_suggest_func = get_store_func('suggest', store)
         suggest = _t_suggest_func
@@ -95,11 +188,19 @@ def get_term_completions(term, store):
         return get_term_expansion(term, store)
     else:
         raise Exception("Not allowed for store: {}".format(store))
-    return suggest({'term': term, 'lang':config.LANG, 'country':config.COUNTRY, 'throttle': config.THROTTLE_DEFAULT})
+    return suggest({'term': term, 'lang':config.lang(), 'country':config.country()})
 
 
 
-def get_closure_of_terms(terms, store, limit=1000, savejson=False):
+def closure_checkpoint_name(kind, store, limit=None):
+    """Name under which the closure of the given kind is checkpointed"""
+    return '_'.join(str(x) for x in (kind, store, config.lang(), config.country(), limit)
+                    if x is not None)
+
+
+def get_closure_of_terms(terms, store, limit=1000, savejson=False,
+                         workers=None, checkpoint_name=None, resume=False,
+                         graph=None):
     """
     Returns a set of terms that is the smallest closure with respect to
     the similarity metric including the given @terms. Build snow-ball starting
@@ -108,14 +209,41 @@ def get_closure_of_terms(terms, store, limit=1000, savejson=False):
     @terms: list of terms (must be iterable)
     @store: 'android' or 'ios'
     @limit: When to stop if the closure gets too big
+    @workers: number of suggestion requests to keep in flight, defaults to
+              config.CLOSURE_WORKERS
+    @checkpoint_name: if given, the closure state is saved in the db under
+              this name every config.CHECKPOINT_EVERY expansions
+    @resume: continue from the last checkpoint saved under @checkpoint_name
+    @graph: the suggestion graph {term: suggested terms}. The suggestions of
+              the terms already in it are taken from it (no RPC), and the new
+              ones are added to it. See download_all_terms_appids.
     """
+    if workers is None:
+        workers = config.CLOSURE_WORKERS
+    state, checkpoint = None, None
+    if checkpoint_name:
+        checkpoint = lambda s: save_checkpoint(checkpoint_name, s)
+        if resume:
+            state = load_checkpoint(checkpoint_name)
     _term_completions = lambda t: get_term_completions(t, store)
+    if graph:
+        # Mostly a walk over the graph in memory, no need for threads
+        _term_completions = lambda t: graph[t] if t in graph \
+            else get_term_completions(t, store)
+        workers = 1
     terms_sugg_dict = get_operation_closure(
         _term_completions, terms, limit=limit,
-        black_list=lambda x: should_allow(x) < 0.5
+        black_list=lambda x: should_allow(x) < 0.5,
+        workers=workers, state=state, checkpoint=checkpoint, graph=graph
     )
+    if checkpoint_name:
+        clear_checkpoint(checkpoint_name)
+    logger.info("Query filter rule hits: {}".format(rule_hits().most_common(20)))
+    logger.info("Cache stats: {}".format(cache.stats()))
     if savejson:
-        outfname = 'data/query_closure_{}_{}.json'.format(store, limit)
+        # One file per locale, the --locales threads write theirs at the same time
+        outfname = os.path.join(config.DATA_DIR, 'query_closure_{}_{}_{}_{}.json'.format(
+            store, config.lang(), config.country(), limit))
         with open(outfname, 'w') as f:
             json.dump(terms_sugg_dict, f, indent=4)
 
@@ -123,41 +251,49 @@ def get_closure_of_terms(terms, store, limit=1000, savejson=False):
 
 
 
-def get_closure_of_apps(appids, store, limit=100):
+def get_closure_of_apps(appids, store, limit=100, workers=None):
+    if workers is None:
+        workers = config.CLOSURE_WORKERS
     assert store in ('android', 'ios'), \
         "Other stores ({!r}) not supported".format(store)
     if not isinstance(appids, (list, set)):
         appids = [appids]
     return get_operation_closure(
         lambda x: get_similar_apps(x, store, limit=10),
-        appids, limit=limit
+        appids, limit=limit, workers=workers
     )
 
 
 def get_appids_for_query(query, store):
-    """For a query, return top 10 apps returned by the store"""
+    """For a query, return top apps returned by the store, in the order of the
+    search results. The listings in the results are saved for the probe stage
+    of the app refresh (refresh.record_listings)."""
     search = get_store_func('search', store)
-    ret = set(
-        a['appId']
-        for a in search({
-            'term': query,
-            'num': config.APPS_PER_QUERY,
-            'throttle': config.THROTTLE_DEFAULT,
-            'lang': config.LANG,
-            'country': config.COUNTRY,
-            'fullDetail': False,
-            'price': 'all'
-        })
-    )
+    results = search({
+        'term': query,
+        'num': config.APPS_PER_QUERY,
+        'lang': config.lang(),
+        'country': config.country(),
+        'fullDetail': False,
+        'price': 'all'
+    })
+    try:
+        record_listings(store, results)
+    except Exception as e:
+        logger.exception("record_listings ({}) >> {}".format(store, e))
+    ret = list(OrderedDict.fromkeys(a['appId'] for a in results))
     return ret
 
 
 
 
-def get_terms_and_apps_for_term(term, store, force=False, limit=1000):
+def get_terms_and_apps_for_term(term, store, force=False, limit=1000, batch=None,
+                                graph=None):
     """A wrapper over the term databse. returns the terms and apps.
     return type= dict: {'terms': [], 'apps': []}
-    
+    If @batch (a list or db_util.WriteBuffer) is given, the new row is
+    appended to it instead of writing it to the db right away; see save_terms.
+    The closure of the term is computed over the suggestion @graph, if given.
     """
     term = term
     db = db_connect()
@@ -166,9 +302,9 @@ def get_terms_and_apps_for_term(term, store, force=False, limit=1000):
     ret = None
     serialize_keys = ['terms', 'apps']
     if exists(table, 'term', term, time_check=force):  # Get from DB
-        ret = list(db.query(
-            'select terms,apps from {0} where term="{1}" COLLATE NOCASE limit 1'
-                .format(table.table.name, term)))[0]
+        ret = list(query(
+            'select terms,apps from {0} where term=:term COLLATE NOCASE limit 1'
+                .format(table.table.name), term=term))[0]
         for k in serialize_keys:
             if k in ret and len(ret[k]) > 0:
                 try:
@@ -182,50 +318,38 @@ def get_terms_and_apps_for_term(term, store, force=False, limit=1000):
         ret = {
             'terms': get_closure_of_terms(
                 terms=[term],
-                store=store, limit=limit),
+                store=store, limit=limit, graph=graph),
             'apps': [x
                      for x in get_appids_for_query(term, store=store)],
             'term': term,
             'time': config.now(),
-            'lang': config.LANG,
-            'country': config.COUNTRY,
+            'lang': config.lang(),
+            'country': config.country(),
         }
         ins_ret = copy.deepcopy(ret)
         for k in serialize_keys:
             if k in ret:
                 ins_ret[k] = json.dumps(ret[k])
-        upsert(table, ins_ret, ['term', 'terms', 'apps']) 
+        if batch is None:
+            upsert(table, ins_ret, TERM_CHECK_COLS)
+            # Also for an unchanged (skipped) term, its edges may predate the
+            # term-app table
+            add_term_apps(store, [ins_ret])
+        else:
+            batch.append(ins_ret)
     return ret
 
 
-
-def update_desc_table(ret, store):
-    """Updates the desc table with the new description for the app in @ret
-    """
-    db = db_connect()
-    table = db.get_table(
-        desc_table_name(store)
-    )
-    desc = ret['description']
-    last_desc_sql = "select description from {0} where appId='{1}' and " \
-                    "time=(select MAX(time) from {0} where appId='{1}')".format(table.table.name, ret['appId'])
-    last_desc = ''
-    try:
-        if 'description' in table.columns:
-            _l_last_desc = list(db.query(last_desc_sql))
-            if _l_last_desc:
-                last_desc = _l_last_desc[0]['description']
-        if last_desc != desc:
-            table.insert({
-                'appId': ret['appId'],
-                'time': config.now(),
-                'description': ret['description']
-        })
-    except Exception as e:
-        logger.error("Exception.update_desc_table!!", e)
-
+TERM_CHECK_COLS = ['term', 'terms', 'apps']
 
 
+def save_terms(rows, store):
+    """Saves the term rows collected by get_terms_and_apps_for_term in one go"""
+    table = db_connect().get_table(term_table_name(store))
+    inserted, skipped = upsert_many(table, rows, TERM_CHECK_COLS)
+    # The skipped (unchanged) terms get their edges too, they may be missing
+    add_term_apps(store, inserted + skipped)
+    return inserted, skipped
 
 
 
@@ -234,7 +358,8 @@ def download_all_reviews(store):
     """Download reviews for each app in the database
     """
     db = db_connect()
-    apps = (r['appId'] for r in db.query('select appId from android_apps'))
+    apps = [r['appId'] for r in db.query(
+        'select distinct appId from {}'.format(app_table_name(store)))]
     for appid in apps:
         download_reviews(appid, store=store, limit=
                          config.NUM_COMMENTS_TO_DOWNLOAD)
@@ -260,34 +385,61 @@ def isactive(appid, store):
 
 def download_app_details_all(store, reviews_too=False, test=False, force=False):
     """
-    Download all the terms and apps for them and store in the databse
+    Download all the terms and apps for them and store in the databse.
+    Unless @force, only the batch of apps picked by refresh.next_refresh_batch
+    is downloaded.
     """
     db = db_connect(test=test)
+    ensure_indexes(store)
     apps_done = set()
     all_appids = get_all_appids(store, test)
     logger.debug("Got all appids: {}".format(len(all_appids)))
-    for i, appid in enumerate(all_appids):
-        if appid not in apps_done:
-            apps_done.add(appid)
-            # download app details
-            download_app_details(appid, store=store, force=True)
-            # print("Downloaded {}. {}".format(i, appid))
-        if i % 10 == 0:
-            logger.info("Done downloading apps ({}): {}".format(store, i))
+    if not force:
+        # Only the apps that are most likely to have changed
+        all_appids = next_refresh_batch(store, all_appids)
+    all_appids = list(OrderedDict.fromkeys(all_appids))
+    # The refresh metadata of the fetched apps, written with the next write
+    # of the buffer, which also saves their rows
+    fetches = []
+
+    def _save(rows):
+        save_app_details(rows, store, fetches[:])
+        del fetches[:]
+    with WriteBuffer(_save) as rows:
+        # download app details, config.APP_BATCH_SIZE apps per call of server.js
+        for batch, batch_rows, batch_fetches in fetch_app_details_batches(
+                all_appids, store=store, force=True):
+            apps_done.update(batch)
+            for row in batch_rows:
+                rows.append(row)
+            # Only once the rows are in the buffer, so that a write while
+            # appending them does not save the metadata before the rows
+            fetches.extend(batch_fetches)
+            logger.info("Done downloading apps ({}): {}".format(store, len(apps_done)))
+            logger.info("Cache stats: {}".format(cache.stats()))
+            logger.info("Refresh stages: {}".format(stage_counts()))
+    # All the rows are saved; the apps gone from the store have no row
+    if fetches:
+        save_fetches(store, fetches)
+    logger.info("Refresh stages ({}): {}".format(store, stage_counts()))
     logger.info("Downloading reviews ({}).. #Apps: {}".format(store, len(apps_done)))
     # download reviews
     if reviews_too:
-        for appid in apps_done:
-            download_reviews(appid, store=store,
-                             limit=config.NUM_COMMENTS_TO_DOWNLOAD)
+        with tracing.span('reviews', 'phase', store=store):
+            for appid in apps_done:
+                with tracing.span('reviews', 'app', appId=appid):
+                    download_reviews(appid, store=store,
+                                     limit=config.NUM_COMMENTS_TO_DOWNLOAD)
 
 
-def download_all_terms_appids(store, test=False, force=False):
+def download_all_terms_appids(store, test=False, force=False, resume=False):
     """Download the appids and terms by search for the terms given in config. 
-    It computes the closure of the terms, before starting.
+    It computes the closure of the terms, before starting. With @resume, the
+    closure continues from its last checkpoint.
 
     """
     db = db_connect(test=test)
+    ensure_indexes(store)
     terms = queries.seed_queries(store)
 
     # Save all the configs
@@ -299,8 +451,21 @@ def download_all_terms_appids(store, test=False, force=False):
     )
 
     config_tab.insert({'key': 'store', 'value': store, 'time': config.now()})
-
-    closure_of_queries = get_closure_of_terms(terms, store=store, savejson=True)
+    config_tab.insert({'key': 'locale', 'value': '{}_{}'.format(
+        config.lang(), config.country()), 'time': config.now()})
+
+    # The suggestions of every term expanded by the snowball are kept, and
+    # the closure of each term below is a walk over this graph.
+    graph = {}
+    with tracing.span('snowball', 'phase', store=store):
+        closure_of_queries = get_closure_of_terms(
+            terms, store=store, limit=config.CLOSURE_SIZE_LIMIT, savejson=True,
+            resume=resume,
+            checkpoint_name=closure_checkpoint_name('snowball', store),
+            graph=graph
+        )
+    logger.info("Suggestion graph: {} terms, {} edges".format(
+        len(graph), sum(len(v) for v in graph.values())))
     config_tab.insert({
         'key': 'snowball',
         'value': json.dumps(closure_of_queries),
@@ -314,37 +479,50 @@ def download_all_terms_appids(store, test=False, force=False):
     print("download_all_terms >> {} Term set size: {}"
           .format(store, len(all_queries)))
     print("download_all_apps.1 >> {} >> {}".format(store, str(all_queries)))
-    for i, term in enumerate(all_queries):
-        if i % 10 == 0:
-            print("download_all_terms.3 >> Done {} terms".format(i))
-            db.commit()
-            config.sleep_time(1)  # I don't want to get blocked.
-        # download terms, appids, and store
-        ret = get_terms_and_apps_for_term(term, store=store, limit=1000, force=True)
-        tterms, apps = ret['terms'], ret['apps']
-        tterms = set(tterms)
-        if not tterms.issubset(all_queries):
-            print("download_all_terms.2 >> Missed for {!r}: {!r}\n" \
-                  .format(term, list(set(tterms) - all_queries)),
-                  file=missed_items_file
-            )
-            # raise Exception("download_all_apps.2 >> Missed:",
-            # tterms-all_queries)
-        print(ret)
+    with WriteBuffer(lambda rows: save_terms(rows, store)) as batch:
+        for i, term in enumerate(all_queries):
+            if i % 10 == 0:
+                print("download_all_terms.3 >> Done {} terms".format(i))
+                logger.info("Rate limits: {}".format(ratelimit.rates()))
+                logger.info("Cache stats: {}".format(cache.stats()))
+            # download terms, appids, and store
+            with tracing.span('term', 'term', term=term):
+                ret = get_terms_and_apps_for_term(term, store=store,
+                                                  limit=config.CLOSURE_SIZE_LIMIT,
+                                                  force=True, batch=batch,
+                                                  graph=graph)
+            tterms, apps = ret['terms'], ret['apps']
+            tterms = set(tterms)
+            if not tterms.issubset(all_queries):
+                print("download_all_terms.2 >> Missed for {!r}: {!r}\n" \
+                      .format(term, list(set(tterms) - all_queries)),
+                      file=missed_items_file
+                )
+                # raise Exception("download_all_apps.2 >> Missed:",
+                # tterms-all_queries)
+            logger.debug("download_all_terms >> {!r}: {} terms, {} apps".format(
+                term, len(tterms), len(apps)))
 
 
 def download_main(**kwargs):
+    """Runs the crawl phases one after the other. Each phase is a span of the
+    crawl trace, see tracing.report."""
     logger.info("1. Downloading the terms first. ({})".format(kwargs.get('store')))
-    download_all_terms_appids(
-        store=kwargs.get('store'), test=kwargs.get('test'), force=kwargs.get('force')
-    )
+    with tracing.span('terms', 'phase', store=kwargs.get('store'),
+                      locale='{}_{}'.format(config.lang(), config.country())):
+        download_all_terms_appids(
+            store=kwargs.get('store'), test=kwargs.get('test'), force=kwargs.get('force'),
+            resume=kwargs.get('resume')
+        )
     logger.info("Finished downloading the terms. Exiting for test.")
 
     logger.info("2. Downloading the app details.")
-    download_app_details_all(
-        store=kwargs.get('store'), test=kwargs.get('test'), force=kwargs.get('force'),
-        reviews_too=kwargs.get('reviews_too')
-    )
+    with tracing.span('apps', 'phase', store=kwargs.get('store'),
+                      locale='{}_{}'.format(config.lang(), config.country())):
+        download_app_details_all(
+            store=kwargs.get('store'), test=kwargs.get('test'), force=kwargs.get('force'),
+            reviews_too=kwargs.get('reviews_too')
+        )
 
     logger.info("3. Downloading the app reviews.")
     logger.info("TODO")
@@ -354,6 +532,28 @@ def download_main(**kwargs):
     # )
 
 
+def download_main_locales(locales, workers=None, **kwargs):
+    """Runs download_main for each of the @locales ('<lang>_<country>') in a
+    pool of @workers (config.LOCALE_WORKERS) threads. The locale is set per
+    thread, and all of them share the node server pool and the db.
+    """
+    def _run(code):
+        with config.use_locale(*config.parse_locale(code)):
+            logger.info("Crawling locale {} ({})".format(code, kwargs.get('store')))
+            return download_main(**kwargs)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers or config.LOCALE_WORKERS) as executor:
+        futures = [(code, executor.submit(_run, code)) for code in locales]
+        for code, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception("Crawl failed for locale {}: {}".format(code, e))
+                failed.append(code)
+    return failed
+
+
 class NewJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, (set)):
@@ -368,7 +568,7 @@ def test_functions(store):
         else 'com.nerdyoctopus.dots'
     # closure_terms = list(get_closure_of_terms(['spy'], store=store))
     # ret = get_app_details('privatealbum', store=store)
-    ret = download_reviews(appid, store=store, limit=41)
+    ret = list(iter_reviews(appid, store=store, limit=41))
     # closure_terms = list(get_closure_of_apps(['com.mojang.minecraftpe'],
     #                                          store='android'))
     # closure_terms = list(get_closure_of_apps(['com.nerdyoctopus.dots'],
@@ -416,22 +616,46 @@ def arguments():
     parser.add_argument('--prod', action="store_true", default=False,
                         help="Stores in databse only if this is true")
     parser.add_argument('--search', action="store", default='', help="Search apps with this query")
+    parser.add_argument('--locales', default='',
+                        help="Comma separated locales to crawl in one process, e.g., "
+                        "en_us,it_it (default: APP_LANG/APP_COUNTRY)")
+    parser.add_argument('--locale-workers', type=int, default=None,
+                        help="Number of locales crawled at the same time (config.LOCALE_WORKERS)")
+    parser.add_argument('--resume', action="store_true", default=False,
+                        help="Continue the query snowball (--qs, --crawl) from its last checkpoint")
+    parser.add_argument('--migrate', dest="action", action="store_const", const="migrate",
+                        help="Migrate the db to the current schema (indexes, backfill the term-app "
+                             "and description tables)")
+    parser.add_argument('--export', metavar='OUTDIR', default='',
+                        help="Export the apps, terms, desc and reviews tables of the store, "
+                        "added since the last export, as Parquet files in OUTDIR")
     parser.add_argument('--similarapps', action="store_const", dest="action", const="similarapps",
                         help="Get closure of apps of the given appIds in --apps")
+    parser.add_argument('--trace-db', action="store_true", default=False,
+                        help="Trace every sqlite statement as well (db spans of the crawl trace)")
+    parser.add_argument('--profile', choices=['cprofile', 'sample'], default=None,
+                        help="Run the action under the deterministic (cprofile) or the "
+                        "sampling profiler, see profiling.py")
+    parser.add_argument('--profile-out', default=None,
+                        help="Write the profile to PROFILE_OUT.txt/.collapsed "
+                        "(default: data/profile)")
+    parser.add_argument('--profile-top', type=int, default=None,
+                        help="Number of hotspots in the table (config.PROFILE_TOP)")
+    parser.add_argument('--profile-io', action="store_true", default=False,
+                        help="Keep the time blocked on zerorpc/gevent I/O in the profile")
     return parser
 
 
-if __name__ == "__main__":
-    parser = arguments()
-    args = parser.parse_args()
-    print(args)
-    logger.info(args)
+def main(args):
+    """Runs the action given by the command line @args (see arguments)"""
     store = args.appstore
     if not store:
         print("appstore cannot be {!r}".format(store))
         exit(-1)
     if args.fresh:
         connect(store, fresh=True)
+    if args.trace_db:
+        trace_db()
     apps = []
     if args.apps:
         if os.path.exists(args.apps[0]):
@@ -444,13 +668,29 @@ if __name__ == "__main__":
 
     if args.action == 'crawl':
         # connect(fresh=True)
-        download_main(
-            store=store, force=False,
-            test=not args.prod, reviews_too=args.reviews
-        )
+        if args.locales:
+            failed = download_main_locales(
+                args.locales.split(','), workers=args.locale_workers,
+                store=store, force=False,
+                test=not args.prod, reviews_too=args.reviews,
+                resume=args.resume
+            )
+            if failed:
+                print("Crawl failed for locales: {}".format(failed))
+        else:
+            download_main(
+                store=store, force=False,
+                test=not args.prod, reviews_too=args.reviews,
+                resume=args.resume
+            )
+        tracing.report('{}_{}'.format(config.TRACE_FILE, store))
     elif args.action == 'test':
         logger.info("Running simple test scripts!")
         test_functions(store)
+    elif args.export:
+        from scraper.export import export_all
+        db = db_connect(test=not args.prod)
+        print("Exported rows: {}".format(export_all(store, args.export)))
     elif args.search:
         logger.info(get_appids_for_query(args.search, store=store))
     elif args.action == 'appdetails':
@@ -478,14 +718,35 @@ if __name__ == "__main__":
 
     elif args.action == 'qs':
         if args.apps[0] == 'all':
-            seed = config.seed_queries(store)
+            seed = queries.seed_queries(store)
         else:
             seed = args.apps
         print("Snowball of {}".format(seed))
         print(seed, store)
-        print(get_closure_of_terms(seed, store, limit=10000))
+        db = db_connect(test=not args.prod)
+        print(get_closure_of_terms(
+            seed, store, limit=10000, resume=args.resume,
+            checkpoint_name=closure_checkpoint_name('qs', store, 10000)
+        ))
+    elif args.action == 'migrate':
+        db = db_connect(test=not args.prod)
+        ensure_indexes(store)
+        print("Term-app edges added: {}".format(migrate_term_apps(store)))
+        print("Descriptions migrated: {}".format(migrate_desc_tables(store)))
     elif args.action == 'similarapps':
         print("Similar apps of {}".format(args.apps))
         print(get_closure_of_apps(args.apps, store, limit=100))
     else:
-        parser.print_help()
+        arguments().print_help()
+
+
+if __name__ == "__main__":
+    args = arguments().parse_args()
+    print(args)
+    logger.info(args)
+    if args.profile:
+        from scraper import profiling
+        profiling.run(main, (args,), mode=args.profile, out=args.profile_out,
+                      top=args.profile_top, ignore_io=not args.profile_io)
+    else:
+        main(args)
@@ -1,4 +1,4 @@
-from scraper.config import LANG, COUNTRY
+from scraper import config
 
 # Add more terms and rerun the python-scraper script to update the tables.
 AGENT = {
@@ -1114,8 +1114,8 @@ GOOGLE_STARTING_QUERY = {
 }
 
 
-def seed_queries(store, LANG=LANG, COUNTRY=COUNTRY):
-    code = '{}_{}'.format(LANG, COUNTRY)
+def seed_queries(store, LANG=None, COUNTRY=None):
+    code = '{}_{}'.format(LANG or config.lang(), COUNTRY or config.country())
     qs = []
     if store in ('android', 'ios'):
         qs = PLAYSTORE_STARTING_QUERIES[code]
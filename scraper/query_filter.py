@@ -4,7 +4,11 @@ to query filtering from other file (e.g., config.py) to this file.
 
 """
 import re
-import sys
+import threading
+from collections import Counter
+from scraper import config
+
+logger = config.setup_logger()
 
 # BLOCKING words
 # Presence of these words immediately qualifies a
@@ -35,6 +39,14 @@ def matched_string(regex):
 
 block_words = re.compile('|'.join(set(BLOCKING_WORDS)), re.I)
 allowed_words = re.compile('|'.join(set(INCLUDING_WORDS)), re.I)
+# Individual rules, only used to attribute a block (or an allowance) to the
+# rule(s) responsible for it.
+_block_rules = [(w, re.compile(w, re.I)) for w in set(BLOCKING_WORDS)]
+_allow_rules = [(w, re.compile(w, re.I)) for w in set(INCLUDING_WORDS)]
+
+_cache = {}
+_rule_hits = Counter()
+_lock = threading.Lock()
 
 def remove_unrelated_apps(word):
     return block_words.search(word)
@@ -43,19 +55,54 @@ def extra_allowance(word):
     m = allowed_words.search(word)
     return m
 
+def _score(query):
+    m = remove_unrelated_apps(query)
+    if not m:
+        return 1  # If not filtered allow
+    blocked_by = [w for w, r in _block_rules if r.search(query)]
+    logger.log(config.QUERY_FILTER_LOG_LEVEL, "Blocking {!r} :: {!r} {}".format(
+        query, matched_string(m), blocked_by))
+    m = extra_allowance(query)
+    allowed_by = [w for w, r in _allow_rules if r.search(query)] if m else []
+    with _lock:
+        _rule_hits.update('block:' + w for w in blocked_by)
+        _rule_hits.update('allow:' + w for w in allowed_by)
+    if m:
+        logger.log(config.QUERY_FILTER_LOG_LEVEL, "-> Allowing {!r} :: {!r}"
+                   .format(query, matched_string(m)))
+        return 1
+    return 0
+
+def score_queries(queries):
+    """Returns the list of scores (see should_allow) of @queries. The score of
+    every (lower cased) query is computed once and cached.
+    """
+    scores = []
+    for q in queries:
+        key = q.lower()
+        score = _cache.get(key)
+        if score is None:
+            score = _score(q)
+            if len(_cache) >= config.QUERY_FILTER_CACHE_SIZE:
+                _cache.clear()
+            _cache[key] = score
+        scores.append(score)
+    return scores
+
+def filter_queries(queries, threshold=0.5):
+    """Returns the queries in @queries whose score is above @threshold"""
+    queries = list(queries)
+    return [q for q, s in zip(queries, score_queries(queries)) if s > threshold]
+
 def should_allow(query):
     """Returns a score (float) specifying what is the chance that we should
     consider this.  I am not putting any limit on the returned score but
     hopefully there will be some before I go too crazy.
     """
-    m = remove_unrelated_apps(query)
-    if m:
-        print("Blocking {!r} :: {!r}".format(query, matched_string(m)),
-              file=sys.stderr)
-        m = extra_allowance(query)
-        if m:
-            print("-> Allowing {!r} :: {!r}".format(query, matched_string(m)),
-                  file=sys.stderr)
-            return 1
-        return 0
-    return 1  # If not filtered allow
+    return score_queries([query])[0]
+
+def rule_hits():
+    """How many distinct queries each rule blocked ('block:<rule>') or let
+    through after a block ('allow:<rule>')"""
+    with _lock:
+        return Counter(_rule_hits)
@@ -0,0 +1,98 @@
+"""
+Rate limiting for all the outbound requests, both the store apis (through
+server.js) and the search engines. There is one token bucket per (store,
+endpoint, locale). The rate of a bucket follows AIMD: it grows slowly while
+the requests succeed and is cut down as soon as the store returns an error
+(or an empty response, which is how server.js reports most errors).
+
+Usage:
+    ratelimit.acquire('android', 'app')    # blocks till a token is available
+    ...make the request...
+    ratelimit.report('android', 'app', ratelimit.OK)
+"""
+import threading
+import time
+from . import config
+
+logger = config.setup_logger()
+
+OK = 'ok'
+EMPTY = 'empty'
+ERROR = 'error'
+
+
+class TokenBucket(object):
+    """A token bucket whose fill rate (requests per second) is adjusted by
+    additive increase and multiplicative decrease."""
+
+    def __init__(self, name, rate, min_rate=None, max_rate=None):
+        self.name = name
+        self.rate = float(rate)
+        self.min_rate = config.RATE_LIMIT_MIN if min_rate is None else min_rate
+        self.max_rate = config.RATE_LIMIT_MAX if max_rate is None else max_rate
+        self.tokens = 1.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        capacity = max(1.0, self.rate)
+        self.tokens = min(capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, n=1):
+        """Blocks till @n tokens are available, and takes them"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if self.tokens >= min(n, max(1.0, self.rate)):
+                    self.tokens -= n
+                    return
+                wait = (min(n, max(1.0, self.rate)) - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def report(self, status):
+        with self.lock:
+            old = self.rate
+            if status == OK:
+                # Roughly +RATE_LIMIT_INCREASE req/sec per second of success
+                self.rate = min(self.max_rate,
+                                self.rate + config.RATE_LIMIT_INCREASE / self.rate)
+            else:
+                factor = config.RATE_LIMIT_DECREASE if status == ERROR \
+                    else config.RATE_LIMIT_EMPTY_DECREASE
+                self.rate = max(self.min_rate, self.rate * factor)
+                self.tokens = min(self.tokens, 0.0)
+        if status == ERROR:
+            logger.info("ratelimit {}: {} -> rate {:.2f} -> {:.2f} req/sec"
+                        .format(self.name, status, old, self.rate))
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(store, endpoint, locale=None):
+    if locale is None:
+        locale = '{}_{}'.format(config.lang(), config.country())
+    key = (store, endpoint, locale)
+    with _buckets_lock:
+        if key not in _buckets:
+            rate = config.RATE_LIMITS.get(
+                endpoint, config.RATE_LIMITS.get(store, config.THROTTLE_DEFAULT))
+            _buckets[key] = TokenBucket('/'.join(key), rate)
+        return _buckets[key]
+
+
+def acquire(store, endpoint, n=1, locale=None):
+    get_bucket(store, endpoint, locale).acquire(n)
+
+
+def report(store, endpoint, status, locale=None):
+    get_bucket(store, endpoint, locale).report(status)
+
+
+def rates():
+    """Current rate of every bucket, for logging"""
+    with _buckets_lock:
+        return {b.name: b.rate for b in _buckets.values()}
@@ -0,0 +1,311 @@
+"""
+Decides which apps to refresh in a crawl. Keeps per app (and locale) refresh
+metadata in the `<store>_refresh` table:
+
+    appId, LANG, COUNTRY
+    first_seen, last_fetched, last_changed: epoch seconds
+    updated: the last `updated` value returned by the store
+    cadence: running estimate (seconds) of how often the app changes
+    fetches, changes: counters
+
+and picks, within a per run budget, the apps that most likely changed: new
+apps first, then the ones whose expected change is most overdue (apps that
+change often, then apps that have not been looked at for long).
+
+An app refresh goes through stages, each one only if the previous one says
+the app may have changed (see stage_counts for how much work each skipped):
+
+    probe:   free, from what we already have. The search results seen in the
+             terms phase (record_listings) give a hash of the app's listing;
+             an app whose listing did not change since its last fetch, less
+             than config.PROBE_MAX_AGE ago, is not fetched.
+    detail:  the `app` call; its version/updated are compared with the last
+             fetch (record_fetch).
+    similar, permissions: only for new apps and apps that changed.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from scraper import config
+from scraper.db_util import (
+    db_connect, refresh_table_name, listings_table_name, ensure_listings_table,
+    text_hash, retry_locked, query, query_many
+)
+
+logger = config.setup_logger()
+
+# Fields of a search result (fullDetail: False) that make the listing hash
+LISTING_FIELDS = ['title', 'summary', 'developer', 'developerId', 'icon',
+                  'price', 'free', 'genre', 'genreId']
+
+# Columns of the refresh table, with an example value of their type
+COLUMNS = {
+    'appId': '', 'LANG': '', 'COUNTRY': '', 'first_seen': 0, 'last_fetched': 0,
+    'updated': '', 'version': '', 'listing_hash': 0, 'fetches': 0,
+    'changes': 0, 'last_changed': 0, 'cadence': 0.0,
+}
+
+_tables_done = set()
+_stages = Counter()
+_stages_lock = threading.Lock()
+
+
+def count_stage(name, n=1):
+    with _stages_lock:
+        _stages[name] += n
+
+
+def stage_counts():
+    """How many apps went through (or were skipped at) each refresh stage"""
+    with _stages_lock:
+        return dict(_stages)
+
+
+def _table(store):
+    return db_connect().get_table(refresh_table_name(store))
+
+
+def listing_hash(app):
+    return text_hash(json.dumps(
+        {k: app.get(k) for k in LISTING_FIELDS}, sort_keys=True, default=str))
+
+
+def record_listings(store, apps):
+    """Saves the listing hash of the @apps (search results of the store)"""
+    apps = [a for a in apps if a.get('appId')]
+    if not apps:
+        return
+    ensure_listings_table(store)
+    rows = [{'appid': a['appId'], 'lang': config.lang(),
+             'country': config.country(), 'hash': listing_hash(a),
+             'time': config.now()} for a in apps]
+    retry_locked(
+        query_many,
+        'insert or replace into {} ("appId", "LANG", "COUNTRY", hash, time) '
+        'values (:appid, :lang, :country, :hash, :time)'.format(
+            listings_table_name(store)),
+        rows
+    )
+
+
+def _select_locale(table, cols, appids=None):
+    """Rows (@cols) of @table in the current locale, only those of @appids
+    if given (read 900 at a time, the sqlite limit of parameters)"""
+    sql = 'select {} from {} where "LANG"=:lang and "COUNTRY"=:country'.format(
+        cols, table)
+    params = {'lang': config.lang(), 'country': config.country()}
+    if appids is None:
+        return list(query(sql, **params))
+    appids = list(set(appids))
+    rows = []
+    for i in range(0, len(appids), 900):
+        ids = {'a{}'.format(j): a for j, a in enumerate(appids[i:i + 900])}
+        rows.extend(query(
+            sql + ' and "appId" in ({})'.format(', '.join(':' + k for k in ids)),
+            **dict(params, **ids)))
+    return rows
+
+
+def get_listings(store, appids=None):
+    """{appId: listing hash} for the current locale (of @appids, or all)"""
+    ensure_listings_table(store)
+    return {r['appId']: r['hash'] for r in _select_locale(
+        listings_table_name(store), '"appId", hash', appids)}
+
+
+def get_listing(store, appid):
+    """Listing hash of @appid in the current locale (None if not seen)"""
+    return get_listings(store, [appid]).get(appid)
+
+
+def _ensure_table(store):
+    """Creates the refresh table, or adds the columns it misses, and the
+    unique (appId, LANG, COUNTRY) key the writes (save_fetches) rely on."""
+    if store in _tables_done:
+        return
+    table = _table(store)
+    for col, example in COLUMNS.items():
+        if not table.has_column(col):
+            table.create_column_by_example(col, example)
+    retry_locked(
+        query,
+        'create unique index if not exists {0}_key on {0} '
+        '("appId", "LANG", "COUNTRY")'.format(refresh_table_name(store)))
+    _tables_done.add(store)
+
+
+def get_refresh_info(store, appids=None):
+    """Returns {appId: refresh metadata} for the current locale (of @appids,
+    or all the apps)"""
+    _ensure_table(store)
+    return {r['appId']: dict(r) for r in _select_locale(
+        refresh_table_name(store), '*', appids)}
+
+
+def priority(info, now=None):
+    """Lower is more urgent. Never fetched apps come first, then the apps in
+    decreasing order of (time since last fetch) / (expected time between
+    changes). Returns None if the app is not worth fetching now.
+    """
+    now = now or time.time()
+    if not info or not info.get('last_fetched'):
+        return (0, 0)
+    since = now - info['last_fetched']
+    if since < config.REFRESH_MIN_INTERVAL:
+        return None
+    cadence = info.get('cadence') or config.REFRESH_DEFAULT_CADENCE
+    return (1, -since / max(cadence, config.REFRESH_MIN_INTERVAL))
+
+
+def probe(info, listing, now=None):
+    """The probe stage: False if, from what we already know, the app did not
+    change since its last fetch. That is, its listing hash (@listing) is the
+    same as at the last fetch, and the last fetch is less than
+    config.PROBE_MAX_AGE old.
+    """
+    now = now or time.time()
+    if not info or not info.get('last_fetched') or listing is None:
+        return True
+    if info.get('listing_hash') != listing:
+        return True
+    return now - info['last_fetched'] >= config.PROBE_MAX_AGE
+
+
+def next_refresh_batch(store, appids, budget=None):
+    """Picks (at most @budget) apps from @appids to refresh in this run,
+    most urgent first. Apps that did not pass the probe stage are left out.
+    """
+    if budget is None:
+        budget = config.REFRESH_BUDGET
+    infos = get_refresh_info(store)
+    listings = get_listings(store)
+    now = time.time()
+    due, skipped = [], 0
+    for appid in set(appids):
+        p = priority(infos.get(appid), now)
+        if p is None:
+            continue
+        if not probe(infos.get(appid), listings.get(appid), now):
+            skipped += 1
+            continue
+        due.append((p, appid))
+    due.sort()
+    batch = [appid for _, appid in due[:budget]]
+    count_stage('probe_skipped', skipped)
+    count_stage('probe_passed', len(due))
+    logger.info("next_refresh_batch ({}) >> {} apps, {} due, {} unchanged "
+                "listing, refreshing {}".format(
+                    store, len(set(appids)), len(due) + skipped, skipped,
+                    len(batch)))
+    return batch
+
+
+class FetchRecorder(object):
+    """Updates the refresh metadata of a batch of fetched apps (@appids): the
+    metadata and listings of the batch are read in one go, and the updates
+    are written by flush() in one statement.
+
+        recorder = FetchRecorder(store, appids)
+        for appid, ret in ...:
+            changed, known = recorder.record(appid, ret)
+        recorder.flush()
+
+    When the fetched apps are saved later (e.g., by a db_util.WriteBuffer),
+    pass recorder.take() to save_fetches after they are saved instead, so an
+    app is never marked as fetched without its row.
+    """
+
+    def __init__(self, store, appids):
+        self.store = store
+        self.appids = set(appids)
+        self.infos = get_refresh_info(store, appids)
+        self.listings = get_listings(store, appids)
+        self.rows = []
+
+    def _lookup(self, appid):
+        # Apps that were not in the batch (ios apps asked by their numeric id)
+        if appid not in self.appids:
+            self.appids.add(appid)
+            self.infos.update(get_refresh_info(self.store, [appid]))
+            self.listings.update(get_listings(self.store, [appid]))
+        return self.infos.get(appid)
+
+    def record(self, appid, ret):
+        """Records the fetch of @appid. @ret is what the store returned
+        (None/empty if the app is gone). Returns (changed, known): whether
+        the app changed (updated or version) since the last fetch, and
+        whether it was fetched before at all.
+        """
+        now = int(time.time())
+        info = self._lookup(appid) or {'first_seen': now, 'fetches': 0, 'changes': 0}
+        known = bool(info.get('last_fetched'))
+        updated = str(ret.get('updated')) if ret else None
+        version = str(ret.get('version')) if ret else None
+        changed = updated != info.get('updated') or \
+            (info.get('version') is not None and version != info['version'])
+        row = {
+            'appid': appid,
+            'lang': config.lang(),
+            'country': config.country(),
+            'first_seen': info.get('first_seen') or now,
+            'last_fetched': now,
+            'updated': updated,
+            'version': version,
+            # The listing seen at this fetch, see probe
+            'listing_hash': self.listings.get(appid) if ret else None,
+            'fetches': (info.get('fetches') or 0) + 1,
+            'changes': info.get('changes') or 0,
+            'last_changed': info.get('last_changed'),
+            'cadence': info.get('cadence'),
+        }
+        if changed:
+            row['changes'] += 1
+            if info.get('last_changed'):
+                interval = now - info['last_changed']
+                row['cadence'] = interval if not info.get('cadence') \
+                    else 0.5 * info['cadence'] + 0.5 * interval
+            row['last_changed'] = now
+        elif row['cadence'] and row['last_changed']:
+            # Quiet for longer than expected, so it changes less often than we think
+            row['cadence'] = max(row['cadence'], now - row['last_changed'])
+        self.rows.append(row)
+        # A later fetch of the same app in this batch builds on this one
+        self.infos[appid] = dict(row, appId=appid, LANG=row['lang'],
+                                 COUNTRY=row['country'])
+        return changed, known
+
+    def take(self):
+        """The metadata recorded so far, to be written with save_fetches once
+        the rows of those apps are saved. The recorder forgets them."""
+        rows, self.rows = self.rows, []
+        return rows
+
+    def flush(self):
+        rows = self.take()
+        if rows:
+            save_fetches(self.store, rows)
+
+
+def save_fetches(store, rows):
+    """Writes the refresh metadata @rows (see FetchRecorder.record)"""
+    retry_locked(
+        query_many,
+        'insert or replace into {} ("appId", "LANG", "COUNTRY", first_seen, '
+        'last_fetched, updated, version, listing_hash, fetches, changes, '
+        'last_changed, cadence) values (:appid, :lang, :country, :first_seen, '
+        ':last_fetched, :updated, :version, :listing_hash, :fetches, '
+        ':changes, :last_changed, :cadence)'.format(refresh_table_name(store)),
+        rows
+    )
+
+
+def record_fetch(store, appid, ret):
+    """Updates the refresh metadata of @appid after fetching it from the
+    store, see FetchRecorder.record. For a batch of apps, use a
+    FetchRecorder.
+    """
+    recorder = FetchRecorder(store, [appid])
+    ret = recorder.record(appid, ret)
+    recorder.flush()
+    return ret
@@ -5,14 +5,14 @@ better search expansion
 """
 import requests
 from lxml import html
-import time, random
-from scraper.query_filter import should_allow
+from scraper import config, http_client
+from scraper.query_filter import filter_queries
 from joblib import Memory
 import io
 from scraper.parse_google import parse_page
 
-HL = 'en'
-CR = 'US'
+HL = None  # Overrides the language of the locale (config.lang())
+CR = None  # Overrides the country of the locale (config.country())
 testing = True
 
 memory = Memory(
@@ -23,14 +23,36 @@ memory = Memory(
 )
 
 def _filter_list(l):
-    return [x for x in l if len(x)>3 and should_allow(x) > 0.5]
+    return filter_queries(x for x in l if len(x)>3)
+
+
+def _locale():
+    """(hl, cr) of the current locale"""
+    return HL or config.lang(), (CR or config.country()).upper()
+
+
+def _get(engine, endpoint, url, **kwargs):
+    """GET through the pooled, rate limited http client (http_client.get),
+    which retries and backs off on errors instead of sleeping blindly."""
+    locale = '{}_{}'.format(*_locale()).lower()
+    return http_client.get(url, engine, endpoint, locale=locale, **kwargs)
+
+
+def _get_or_none(engine, endpoint, url, **kwargs):
+    """_get, but None if the request failed (after the retries)"""
+    try:
+        r = _get(engine, endpoint, url, **kwargs)
+    except requests.RequestException as e:
+        print("ERROR: {} {} failed: {}".format(engine, endpoint, e))
+        return None
+    return r if r.ok else None
 
 # Bing
 BING_API = "http://api.bing.com/osjson.aspx?query="
 @memory.cache(ignore=['filter_list'])
 def bing_suggest(q, filter_list=_filter_list):
-    r = requests.get(BING_API + q.replace(' ', '+'))
-    if not r.ok:
+    r = _get_or_none('bing', 'suggest', BING_API + q.replace(' ', '+'))
+    if r is None:
         print("ERROR: Search failed for {} in Bing".format(q))
         return []
     else:
@@ -44,17 +66,18 @@ UA = {
     'accept-encoding': "compress, gzip"
 }
 @memory.cache(ignore=['filter_list'])
-def google_suggest(q, filter_list=_filter_list):
+def google_suggest(q, filter_list=_filter_list, hl=None, cr=None):
     """
     parses the google search pages. 
     """
-    url = GOOGLE_RELATED_QUERY_API.format(q='+'.join(q.split()), hl=HL, cr=CR)
+    if not hl or not cr:
+        hl, cr = _locale()
+    url = GOOGLE_RELATED_QUERY_API.format(q='+'.join(q.split()), hl=hl, cr=cr)
     print(url)
     try:
-        r = requests.get(url, headers=UA, timeout=2)
-        tree = html.fromstring(r.content)
+        r = _get('google', 'related', url, headers=UA, timeout=2)
         assert r.ok, "Return code from google: {}".format(r.status_code)
-        time.sleep(random.random())
+        tree = html.fromstring(r.content)
         return filter_list([
             e.text_content() for e in 
             tree.xpath('//p//a')
@@ -62,9 +85,6 @@ def google_suggest(q, filter_list=_filter_list):
     except Exception as ex:
         print("Exception: {}".format(ex))
         print("ERROR: Failed for q={} in Google".format(q))
-        if r.status_code == 503:
-            print("Extra sleep")
-            time.sleep(60)  # Wait a minute.
         return []
 
 
@@ -80,18 +100,13 @@ def google_search(q, n=30, site=None):
         q = 'site:{} {}'.format(site, q)
     url = GOOGLE_SEARCH_QUERY.format(q='+'.join(q.split()))
     try:
-        r = requests.get(url, headers=UA, timeout=2)
-        tree = html.fromstring(r.content)
+        r = _get('google', 'search', url, headers=UA, timeout=2)
         assert r.ok, "Return code from google: {}".format(r.status_code)
-        time.sleep(random.random())
         links, suggestions, ads = parse_page(io.BytesIO(r.content))
 
     except Exception as ex:
         print("Exception: {}".format(ex))
         print("ERROR: Failed for q={} in Google".format(q))
-        if r.status_code == 503:
-            print("Extra sleep")
-            time.sleep(60)  # Wait a minute.
         links, suggestions, ads = [], [], []
     return {
         'links': links,
@@ -103,18 +118,18 @@ def google_search(q, n=30, site=None):
 
 GOOGLE_COMPLETION_QUERY_API = "http://suggestqueries.google.com/complete/search?q={}&client=firefox&hl={hl}&cr=country{cr}"
 @memory.cache(ignore=['filter_list'])
-def google_complete(q, filter_list=_filter_list):
+def google_complete(q, filter_list=_filter_list, hl=None, cr=None):
     """
     Uses google query completion API
     """
+    if not hl or not cr:
+        hl, cr = _locale()
     q = q.replace(' ', '+')
-    url = GOOGLE_COMPLETION_QUERY_API.format(q=q, hl=HL, cr=CR)
-    r = requests.get(url)
-    if not r.ok:
+    url = GOOGLE_COMPLETION_QUERY_API.format(q=q, hl=hl, cr=cr)
+    r = _get_or_none('google', 'complete', url)
+    if r is None:
         print("ERROR: Search Failed for {} in Google completion".format(q))
         return []
-    # Make sure google does not get angry with us
-    time.sleep(random.random())
     try:
         rq, rd = r.json()
         return filter_list(rd)
@@ -126,25 +141,24 @@ def google_complete(q, filter_list=_filter_list):
 
 
 # Google Play completion api
-PLAY_STORE_API="https://market.android.com/suggest/SuggRequest?json=1&c=3&query={}&hl=en&gl=US".format
+PLAY_STORE_API="https://market.android.com/suggest/SuggRequest?json=1&c=3&query={q}&hl={hl}&gl={cr}".format
 @memory.cache(ignore=['filter_list'])
-def play_store_complete(q, filter_list=_filter_list):
+def play_store_complete(q, filter_list=_filter_list, hl=None, cr=None):
     """
     Use google play scraper
     """
-    url = PLAY_STORE_API(q)
-    r = requests.get(url)
-    if not r.ok:
+    if not hl or not cr:
+        hl, cr = _locale()
+    url = PLAY_STORE_API(q=q, hl=hl, cr=cr)
+    r = _get_or_none('play', 'complete', url)
+    if r is None:
         print("ERROR: Search Failed for {} in Play Store completion".format(q))
         return []
-    # Make sure google does not get angry with us
     try:
         return filter_list([rd['s'] for rd in r.json()])
     except Exception as e:
         print("Exception:::", e, r.text)
         return []
-    finally:
-        time.sleep(random.random()) 
 
 
 def get_term_expansion(term, store):
@@ -154,12 +168,15 @@ def get_term_expansion(term, store):
     assert store in ('google-related', 'google-comp', 'bing', 'android'), \
         "store={} not supported".format(store)
 
+    if store == 'bing':
+        return bing_suggest(term)
+    # The locale is passed explicitly, so that it is a part of the cache key
+    hl, cr = _locale()
     return {
         'google-related': google_suggest,
         'google-comp': google_complete,
-        'bing': bing_suggest,
         'android': play_store_complete
-    }[store](term)
+    }[store](term, hl=hl, cr=cr)
 
 
 if __name__ == "__main__":
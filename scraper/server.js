@@ -5,7 +5,10 @@
  * It uses zerorpc to communicate using a Unix socket.
  *
  * If you find the server is stuck (that is python scrapper is stuck),
- * probably you have to remove the unix_socket /tmp/ipv-spyware.sock.
+ * probably you have to remove the unix_socket /tmp/ipv-spyware_<store>_<i>.sock.
+ *
+ * $ node server.js [android|ios] [sock_path]
+ * Python starts a pool of these servers, one per socket (see appstore_api.py).
  *
  */
 const process = require("process");
@@ -50,6 +53,60 @@ function create_reply(name, api) {
     }
 }
 
+// Batch version of an api: takes {queries: [query, ...], concurrency: n}, and
+// runs the queries, n at a time (BATCH_CONCURRENCY by default). Results are
+// streamed back one by one, as they finish (not in the order of the queries):
+// {i: index of the query, appId, ok: true, result, ms}, or
+// {i, appId, ok: false, error, ms} if that query failed.
+var BATCH_CONCURRENCY = 4;
+
+function create_batch_reply(name, api) {
+    all_apis[name] = function (batch, reply) {
+        var queries = batch['queries'] || [];
+        var concurrency = batch['concurrency'] || BATCH_CONCURRENCY;
+        var next = 0;
+        var finished = 0;
+        console.log(name, queries.length, 'queries');
+        if (queries.length == 0) {
+            reply(null, [], false);
+            return;
+        }
+        function run_next() {
+            var i = next++;
+            var query = queries[i];
+            var item = {i: i, appId: query['appId'] || String(query['id'])};
+            var start = Date.now();
+            convert_to_ascii(query);
+            api(query)
+                .then((res) => {
+                    item.ok = true;
+                    item.result = res;
+                })
+                .catch((err) => {
+                    console.log(name, item.appId, err);
+                    item.ok = false;
+                    item.error = String((err && err.message) || err);
+                })
+                .then(() => {
+                    item.ms = Date.now() - start;
+                    finished++;
+                    reply(null, item, true);
+                    if (finished == queries.length) {
+                        reply();  // end of the stream
+                    } else if (next < queries.length) {
+                        run_next();
+                    }
+                });
+        }
+        for (var k = 0; k < Math.min(concurrency, queries.length); k++) {
+            run_next();
+        }
+    }
+}
+
+// The apis that also get a <store>_<api>_batch endpoint
+var batch_apis = ['app'];
+
 var ios_api_dict = {
     app: appstore.app,
     list: appstore.list,
@@ -79,15 +136,21 @@ case "android":
     Object.keys(android_api_dict).forEach(
         key => create_reply('android_' + key, android_api_dict[key])
     );
+    batch_apis.forEach(
+        key => create_batch_reply('android_' + key + '_batch', android_api_dict[key])
+    );
     break;
 case "ios":
     Object.keys(ios_api_dict).forEach(
         key => create_reply('ios_' + key, ios_api_dict[key])
     );
+    batch_apis.forEach(
+        key => create_batch_reply('ios_' + key + '_batch', ios_api_dict[key])
+    );
     break;
 default:
     console.log("No store provided " + process.argv +". Should be");
-    console.log("$ node server.js [android|ios]");
+    console.log("$ node server.js [android|ios] [sock_path]");
     process.exit(1);
 }
 
@@ -95,7 +158,7 @@ console.log(all_apis);
 
 var server = new zerorpc.Server(all_apis);
 // server.bind("tcp://0.0.0.0:4242");
-var sock_path = "/tmp/ipv-spyware_" + process.argv[2] + ".sock";
+var sock_path = process.argv[3] || "/tmp/ipv-spyware_" + process.argv[2] + ".sock";
 if (fs.existsSync(sock_path)) {
     throw("File already exists...kill running server and/or delete the sock file. " + sock_path);
 }
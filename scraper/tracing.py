@@ -0,0 +1,178 @@
+"""
+Tracing of a crawl: where does the time go? Spans are opened with
+
+    with tracing.span('terms', 'phase'):
+        ...
+
+and nest per thread; a span's parent is the innermost open span of the
+thread (or, for functions handed to a thread pool through tracing.bind, the
+span that submitted them). The kind of a span is one of KINDS: the crawl
+phases, one span per term and per app, the store/http calls (rpc), the
+sqlite statements (db, with --trace-db, see db_util.trace_db) and the rate
+limiter (wait).
+
+At the end of the crawl, report() logs and saves a summary (wall time of
+every phase, and the time spent in rpc vs db vs wait vs python, counting
+only the time not inside a nested span of the same thread), and a trace that
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from scraper import config
+
+logger = config.setup_logger()
+
+KINDS = ['phase', 'term', 'app', 'rpc', 'db', 'wait', 'python']
+# Time in these kinds of spans is time waiting on something; the rest is python
+WAIT_KINDS = ['rpc', 'db', 'wait']
+
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_spans = []  # finished spans, up to config.TRACE_MAX_SPANS
+_self_time = defaultdict(float)  # kind: seconds not in a nested span
+_counts = defaultdict(int)  # kind: number of spans
+_phases = []  # (name, wall seconds)
+_dropped = [0]
+
+
+class Span(object):
+    __slots__ = ('id', 'parent', 'name', 'kind', 'attrs', 'start', 'end',
+                 'tid', 'child_time')
+
+    def __init__(self, name, kind, parent, attrs):
+        self.id = next(_ids)
+        self.parent = parent
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.tid = threading.get_ident()
+        self.child_time = 0.0
+        self.start = time.time()
+        self.end = None
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """The innermost open span of this thread (or its bound parent)"""
+    stack = _stack()
+    return stack[-1] if stack else getattr(_local, 'parent', None)
+
+
+def start(name, kind='python', **attrs):
+    """Opens a span, to be closed with finish(). Use span() where possible."""
+    parent = current()
+    s = Span(name, kind, parent.id if parent else None, attrs)
+    _stack().append(s)
+    return s
+
+
+def finish(s):
+    s.end = time.time()
+    stack = _stack()
+    if s in stack:
+        stack.remove(s)
+    duration = s.end - s.start
+    if stack and stack[-1].tid == s.tid:
+        stack[-1].child_time += duration
+    with _lock:
+        _self_time[s.kind] += duration - s.child_time
+        _counts[s.kind] += 1
+        if s.kind == 'phase':
+            _phases.append((s.name, duration))
+        if len(_spans) < config.TRACE_MAX_SPANS:
+            _spans.append(s)
+        else:
+            _dropped[0] += 1
+
+
+@contextmanager
+def span(name, kind='python', **attrs):
+    """with span(name, kind, **attrs): ..."""
+    s = start(name, kind, **attrs)
+    try:
+        yield s
+    except Exception as e:
+        s.attrs['error'] = repr(e)
+        raise
+    finally:
+        finish(s)
+
+
+def bind(func):
+    """Wraps @func so that the spans it opens in another thread (e.g., in a
+    thread pool) are children of the current span"""
+    parent = current()
+
+    def _func(*args, **kwargs):
+        old = getattr(_local, 'parent', None)
+        _local.parent = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.parent = old
+    return _func
+
+
+def summary():
+    """Wall time of the phases, and the (thread) seconds spent in rpc, db,
+    wait and python, excluding the nested spans"""
+    with _lock:
+        seconds = {k: _self_time.get(k, 0.0) for k in WAIT_KINDS}
+        seconds['python'] = sum(v for k, v in _self_time.items()
+                                if k not in WAIT_KINDS)
+        return {
+            'phases': [{'name': n, 'seconds': round(d, 3)} for n, d in _phases],
+            'seconds': {k: round(v, 3) for k, v in seconds.items()},
+            'self_seconds': {k: round(v, 3) for k, v in _self_time.items()},
+            'counts': dict(_counts),
+            'dropped_spans': _dropped[0],
+        }
+
+
+def chrome_trace():
+    """The finished spans in the chrome trace event format"""
+    pid = os.getpid()
+    with _lock:
+        spans = list(_spans)
+    events = []
+    for s in spans:
+        args = dict(s.attrs, id=s.id, parent=s.parent)
+        events.append({
+            'name': s.name, 'cat': s.kind, 'ph': 'X', 'pid': pid, 'tid': s.tid,
+            'ts': int(s.start * 1e6), 'dur': int((s.end - s.start) * 1e6),
+            'args': {k: v if isinstance(v, (int, float, str, type(None))) else str(v)
+                     for k, v in args.items()},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def report(path=None):
+    """Logs the summary, and writes it to @path_summary.json and the trace
+    to @path.json. @path defaults to config.TRACE_FILE."""
+    path = path or config.TRACE_FILE
+    s = summary()
+    for p in s['phases']:
+        logger.info("Phase {name}: {seconds:.1f} sec".format(**p))
+    total = sum(s['seconds'].values()) or 1.0
+    logger.info("Time in: {}".format(', '.join(
+        '{} {:.1f}s ({:.0%})'.format(k, v, v / total)
+        for k, v in sorted(s['seconds'].items(), key=lambda x: -x[1]))))
+    try:
+        with open(path + '_summary.json', 'w') as f:
+            json.dump(s, f, indent=2)
+        with open(path + '.json', 'w') as f:
+            json.dump(chrome_trace(), f)
+    except (IOError, OSError) as e:
+        logger.info("tracing.report >> {}".format(e))
+    return s
@@ -0,0 +1,48 @@
+"""
+Fixtures of the tests. Every test that touches the db gets a fresh sqlite
+file, and nothing is written to data/.
+
+$ python -m pytest -q
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scraper import config, db_util, cache, refresh, ratelimit  # noqa: E402
+
+
+@pytest.fixture(autouse=True, scope='session')
+def _outputs(tmp_path_factory):
+    out = tmp_path_factory.mktemp('out')
+    config.METRICS_FILE = str(out / 'metrics')
+    config.TRACE_FILE = str(out / 'trace')
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh (test) db, with the per process "table is ready" flags reset"""
+    monkeypatch.setattr(config, 'TEST_DB_FILE', str(tmp_path / 'apps_test.db'))
+    monkeypatch.setattr(db_util, 'db', None)
+
+    def _reset():
+        for done in [db_util._desc_tables_done, db_util._term_apps_done,
+                     db_util._listings_done, db_util._indexes_done,
+                     refresh._tables_done]:
+            done.clear()
+        for c in cache._caches.values():
+            c._created = False
+    _reset()
+    yield db_util.db_connect()
+    _reset()
+
+
+@pytest.fixture
+def fast_ratelimit(monkeypatch):
+    """No waiting in the rate limiter"""
+    monkeypatch.setattr(config, 'THROTTLE_DEFAULT', 1000)
+    monkeypatch.setattr(config, 'RATE_LIMITS', {})
+    ratelimit._buckets.clear()
+    yield
+    ratelimit._buckets.clear()
@@ -0,0 +1,122 @@
+"""
+The app_batch endpoint and fetch_app_details_batches, against fake_store.py
+(the same zerorpc methods as server.js) started on a temporary socket.
+"""
+import os
+import subprocess
+import sys
+import time
+import zlib
+import pytest
+
+pytest.importorskip('zerorpc')
+from scraper import (  # noqa: E402
+    config, appstore_api, appdetails, metrics, refresh, tracing,
+)
+
+STORE = 'android'
+
+
+def _calls(endpoint):
+    return metrics.get_metrics().get('{}_{}'.format(STORE, endpoint), {}).get('calls', 0)
+
+
+def _gone_appid():
+    """An app fake_store.py says is not in the store"""
+    i = 0
+    while zlib.crc32('com.fake.app{}'.format(i).encode('utf8')) % 97:
+        i += 1
+    return 'com.fake.app{}'.format(i)
+
+
+@pytest.fixture(scope='module')
+def fake_store(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('sock')
+    old = config.SOCK_PATH, config.NODE_WORKERS
+    config.SOCK_PATH, config.NODE_WORKERS = str(tmp / 'fake'), 1
+    sock = appstore_api.sock_path(STORE)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'scraper.fake_store', STORE, sock,
+         '--latency', '0.01'],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    for _ in range(200):
+        if os.path.exists(sock):
+            break
+        time.sleep(0.05)
+    # The fake server is up, connect() only registers it
+    appstore_api._started.discard(STORE)
+    appstore_api._outstanding.pop(STORE, None)
+    appstore_api._clients.__dict__.clear()
+    yield sock
+    proc.kill()
+    proc.wait()
+    appstore_api._started.discard(STORE)
+    appstore_api._outstanding.pop(STORE, None)
+    appstore_api._clients.__dict__.clear()
+    config.SOCK_PATH, config.NODE_WORKERS = old
+
+
+def test_batch_streams_every_query(fake_store, fast_ratelimit):
+    appids = ['com.fake.app{}'.format(i) for i in range(5)] + [_gone_appid()]
+    app_batch = appstore_api.get_store_batch('app', STORE)
+    items = list(app_batch([{'appId': a} for a in appids], concurrency=3))
+    assert sorted(item['i'] for item in items) == list(range(len(appids)))
+    for item in items:
+        assert item['appId'] == appids[item['i']]
+        if item['appId'] == _gone_appid():
+            assert not item['ok'] and item['error']
+        else:
+            assert item['ok'] and item['result']['appId'] == item['appId']
+    # the worker is released once the stream is read
+    assert appstore_api._outstanding[STORE] == [0]
+
+
+def test_fetch_app_details_batches(db, fake_store, fast_ratelimit):
+    appids = ['com.fake.app{}'.format(i) for i in range(7)] + [_gone_appid()]
+    batches = list(appdetails.fetch_app_details_batches(
+        appids, STORE, force=True, batch_size=3))
+    assert [b for b, _, _ in batches] == [appids[:3], appids[3:6], appids[6:]]
+    rows = [r for _, rs, _ in batches for r in rs if r]
+    fetches = [f for _, _, fs in batches for f in fs]
+    assert sorted(r['appId'] for r in rows) == sorted(appids[:-1])
+    assert all('similar' in r and 'permissions' in r for r in rows)
+    # Nothing is marked as fetched until the rows are saved
+    assert refresh.get_refresh_info(STORE, appids) == {}
+    assert sorted(f['appid'] for f in fetches) == sorted(appids)
+    appdetails.save_app_details(rows, STORE, fetches)
+    assert sorted(refresh.get_refresh_info(STORE, appids)) == sorted(appids)
+
+    # Fetched again: known and unchanged, no similar apps nor permissions
+    similar = _calls('similar')
+    batches = list(appdetails.fetch_app_details_batches(
+        appids, STORE, force=True, batch_size=3))
+    rows = [r for _, rs, _ in batches for r in rs if r]
+    assert rows == [{'appId': a} for a in appids[:-1]]
+    assert _calls('similar') == similar
+
+
+def test_one_trace_span_per_app(db, fake_store, fast_ratelimit, monkeypatch):
+    monkeypatch.setattr(tracing, '_spans', [])
+    appids = ['com.fake.app{}'.format(i) for i in range(20, 23)] + [_gone_appid()]
+    list(appdetails.fetch_app_details_batches(appids, STORE, force=True))
+    spans = {s.attrs['appId']: s for s in tracing._spans if s.kind == 'app'}
+    assert sorted(spans) == sorted(appids)
+    assert all(s.attrs['store_ms'] >= 0 for s in spans.values())
+    assert spans[_gone_appid()].attrs['error']
+    assert not any('error' in spans[a].attrs for a in appids[:-1])
+    # the app spans are nested in the span of their batch
+    batch = next(s for s in tracing._spans if s.name == 'app_batch')
+    assert all(s.parent == batch.id for s in spans.values())
+
+
+def test_fallback_to_single_calls(db, fake_store, fast_ratelimit, monkeypatch):
+    # fake_store.py has no `android_nobatch_batch`, as an older server.js
+    monkeypatch.setattr(appdetails, 'get_store_batch',
+                        lambda func, store: appstore_api.get_store_batch('nobatch', store))
+    appids = ['com.fake.app{}'.format(i) for i in range(10, 14)]
+    app_calls = _calls('app')
+    batches = list(appdetails.fetch_app_details_batches(appids, STORE, force=True))
+    rows = [r for _, rs, _ in batches for r in rs if r]
+    assert sorted(r['appId'] for r in rows) == appids
+    assert _calls('app') - app_calls == len(appids)
+    assert appstore_api._outstanding[STORE] == [0]
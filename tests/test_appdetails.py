@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip('zerorpc')
+from scraper import appdetails, refresh, db_util  # noqa: E402
+
+STORE = 'android'
+
+
+@pytest.fixture
+def app_row(db, monkeypatch):
+    """_app_row of an app fetched from the store, without calling the store"""
+    monkeypatch.setattr(appdetails, 'get_similar_apps', lambda appid, store: ['b'])
+    monkeypatch.setattr(appdetails, 'get_permissions',
+                        lambda appid, store, version=None: ['internet'])
+    table = db.get_table(db_util.app_table_name(STORE))
+
+    def _app_row(ret):
+        recorder = refresh.FetchRecorder(STORE, [ret['appId']])
+        row = appdetails._app_row({'appId': ret['appId']}, ret['appId'], dict(ret),
+                                  STORE, table, False, recorder)
+        recorder.flush()
+        return row
+    return _app_row
+
+
+def test_unchanged_apps_are_only_marked_as_seen(app_row):
+    # Updated years ago (epoch ms), as most of the apps in the store
+    app = {'appId': 'a', 'title': 'Spy', 'updated': 1262304000000, 'version': '1.0'}
+    assert 'similar' in app_row(app)
+    assert app_row(app) == {'appId': 'a'}
+
+
+def test_changes_of_old_apps_are_saved(app_row):
+    app = {'appId': 'a', 'title': 'Spy', 'updated': 1262304000000, 'version': '1.0'}
+    app_row(app)
+    row = app_row(dict(app, updated=1262390400000, version='1.1'))
+    assert row['version'] == '1.1' and row['similar'] == '["b"]'
+    assert row['permissions'] == '["internet"]'
@@ -0,0 +1,70 @@
+import threading
+import pytest
+
+pytest.importorskip('zerorpc')
+from scraper import config, appstore_api  # noqa: E402
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """The node pool of a store, without starting any node server"""
+    started = []
+    monkeypatch.setattr(config, 'NODE_WORKERS', 3)
+    monkeypatch.setattr(appstore_api, '_start_server',
+                        lambda store, sock, js, fresh=False: started.append((sock, fresh)))
+    monkeypatch.setattr(appstore_api, '_started', set())
+    monkeypatch.setattr(appstore_api, '_outstanding', {})
+    monkeypatch.setattr(appstore_api, '_generation', {})
+    return started
+
+
+def test_connect_starts_the_pool_once(pool):
+    threads = [threading.Thread(target=appstore_api.connect, args=('android',))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(pool) == config.NODE_WORKERS
+
+
+def test_least_outstanding_worker(pool):
+    workers = [appstore_api._acquire_worker('android') for _ in range(4)]
+    assert sorted(workers[:3]) == [0, 1, 2]
+    appstore_api._release_worker('android', workers[1])
+    assert appstore_api._acquire_worker('android') == workers[1]
+
+
+def test_restart_keeps_the_calls_in_flight(pool):
+    worker = appstore_api._acquire_worker('android')
+    appstore_api.connect('android', fresh=True)
+    assert appstore_api._outstanding['android'][worker] == 1
+    appstore_api._release_worker('android', worker)
+    assert appstore_api._outstanding['android'] == [0] * config.NODE_WORKERS
+    assert appstore_api._generation['android'] == 1
+
+
+def test_restart_reconnects_every_thread(pool, monkeypatch):
+    clients = []
+
+    class Client(object):
+        def __init__(self):
+            self.closed = False
+            clients.append(self)
+
+        def connect(self, endpoint):
+            pass
+
+        def close(self):
+            self.closed = True
+    monkeypatch.setattr(appstore_api.zerorpc, 'Client', Client)
+    monkeypatch.setattr(appstore_api, '_clients', threading.local())
+    old = []
+    t = threading.Thread(target=lambda: old.append(appstore_api._client('android', 0)))
+    t.start()
+    t.join()
+    mine = appstore_api._client('android', 0)
+    assert appstore_api._client('android', 0) is mine
+    appstore_api.connect('android', fresh=True)
+    assert appstore_api._client('android', 0) is not mine and mine.closed
+    assert len(clients) == 3 and clients[0] is old[0]
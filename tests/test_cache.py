@@ -0,0 +1,52 @@
+import time
+from scraper.cache import TTLCache
+
+
+def test_set_and_get(db):
+    c = TTLCache('test_get', ttl=100)
+    assert c.get(('android', 'spy')) is None
+    c.set(('android', 'spy'), ['spy app', 'spy phone'])
+    assert c.get(('android', 'spy')) == ['spy app', 'spy phone']
+    assert c.get(('ios', 'spy'), default=[]) == []
+    assert c.stats()['hits'] == 1 and c.stats()['misses'] == 2
+
+
+def test_entries_expire_after_the_ttl(db, monkeypatch):
+    c = TTLCache('test_expiry', ttl=100)
+    c.set(('spy',), ['a'])
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 50)
+    assert c.get(('spy',)) == ['a']
+    monkeypatch.setattr(time, 'time', lambda: now + 150)
+    assert c.get(('spy',)) is None
+    assert c.stats()['expired'] == 1
+    c.purge()
+    assert list(db.query('select count(*) as n from cache_test_expiry'))[0]['n'] == 0
+
+
+def test_empty_results_are_not_cached_by_default(db):
+    calls = []
+
+    def suggest():
+        calls.append(1)
+        return []
+    c = TTLCache('test_empty', ttl=100)
+    assert c.get_or_compute(('spy',), suggest) == []
+    assert c.get_or_compute(('spy',), suggest) == []
+    assert len(calls) == 2
+    c = TTLCache('test_empty_cached', ttl=100, cache_empty=True)
+    c.get_or_compute(('spy',), suggest)
+    c.get_or_compute(('spy',), suggest)
+    assert len(calls) == 3
+
+
+def test_get_or_compute_calls_once(db):
+    calls = []
+
+    def suggest():
+        calls.append(1)
+        return ['spy app']
+    c = TTLCache('test_compute', ttl=100)
+    assert c.get_or_compute(('spy',), suggest) == ['spy app']
+    assert c.get_or_compute(('spy',), suggest) == ['spy app']
+    assert len(calls) == 1
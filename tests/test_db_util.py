@@ -0,0 +1,94 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from scraper import config
+from scraper.db_util import upsert_many, WriteBuffer
+
+CHECK_COLS = ['term', 'apps']
+
+
+def test_upsert_many_inserts_new_rows(db):
+    table = db.get_table('android_terms')
+    rows = [{'term': 'spy', 'apps': '["a"]'}, {'term': 'gps', 'apps': '[]'}]
+    inserted, skipped = upsert_many(table, rows, CHECK_COLS)
+    assert [r['term'] for r in inserted] == ['spy', 'gps']
+    assert skipped == []
+    assert table.count() == 2
+    assert all(r['time'] for r in table.all())
+
+
+def test_upsert_many_skips_existing_and_duplicate_rows(db):
+    table = db.get_table('android_terms')
+    upsert_many(table, [{'term': 'spy', 'apps': '["a"]'}], CHECK_COLS)
+    rows = [
+        {'term': 'spy', 'apps': '["a"]'},       # already there
+        {'term': 'spy', 'apps': '["a", "b"]'},  # changed
+        {'term': 'gps', 'apps': '[]'},
+        {'term': 'gps', 'apps': '[]'},          # twice in the batch
+    ]
+    inserted, skipped = upsert_many(table, rows, CHECK_COLS)
+    assert [(r['term'], r['apps']) for r in inserted] == \
+        [('spy', '["a", "b"]'), ('gps', '[]')]
+    assert len(skipped) == 2
+    assert table.count() == 3
+
+
+def test_upsert_many_time_check_only_skips_rows_of_today(db):
+    table = db.get_table('android_terms')
+    table.insert({'term': 'spy', 'apps': '[]', 'time': '20000101:0000'})
+    inserted, skipped = upsert_many(table, [{'term': 'spy', 'apps': '[]'}],
+                                    CHECK_COLS, time_check=True)
+    assert len(inserted) == 1 and not skipped
+    inserted, skipped = upsert_many(table, [{'term': 'spy', 'apps': '[]'}],
+                                    CHECK_COLS, time_check=True)
+    assert not inserted and len(skipped) == 1
+
+
+def test_upsert_many_table_does_not_exist_yet(db):
+    table = db.get_table('android_new')
+    inserted, skipped = upsert_many(table, [{'term': 'spy', 'apps': '[]'}],
+                                    CHECK_COLS)
+    assert len(inserted) == 1 and not skipped
+
+
+def test_write_buffer_flushes_every_max_rows(db):
+    written = []
+    with WriteBuffer(written.append, max_rows=2, max_seconds=3600) as rows:
+        for i in range(5):
+            rows.append({'i': i})
+        rows.append(None)
+        assert [len(w) for w in written] == [2, 2]
+    assert [len(w) for w in written] == [2, 2, 1]
+
+
+def test_upsert_many_retries_locked_database(db, monkeypatch):
+    table = db.get_table('android_terms')
+    upsert_many(table, [{'term': 'spy', 'apps': '[]'}], CHECK_COLS)
+    query = table.db.query
+    calls = []
+
+    def locked_once(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise OperationalError('select', {}, Exception('database is locked'))
+        return query(*args, **kwargs)
+    monkeypatch.setattr(table.db, 'query', locked_once)
+    monkeypatch.setattr(config, 'DB_LOCK_MAX_WAIT', 0)
+    inserted, skipped = upsert_many(table, [{'term': 'spy', 'apps': '[]'}], CHECK_COLS)
+    assert not inserted and len(skipped) == 1 and len(calls) == 2
+    monkeypatch.setattr(config, 'DB_LOCK_RETRIES', 1)
+    calls.clear()
+    with pytest.raises(OperationalError):
+        upsert_many(table, [{'term': 'spy', 'apps': '[]'}], CHECK_COLS)
+    assert table.count() == 1
+
+
+def test_existence_checks_search_the_indexes(db):
+    from scraper.db_util import ensure_indexes, app_table_name
+    table = db.get_table(app_table_name('ios'))
+    table.insert({'appId': 'com.spy', 'iosid': 123, 'time': '20200101:1010'})
+    ensure_indexes('ios')
+    for col, value in [('appId', 'COM.SPY'), ('iosid', '123')]:
+        plan = list(db.query(
+            'explain query plan select 1 from {} where {}= :value COLLATE NOCASE '
+            'limit 1'.format(table.table.name, col), value=value))
+        assert plan[0]['detail'].startswith('SEARCH'), plan
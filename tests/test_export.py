@@ -0,0 +1,62 @@
+import json
+import pytest
+from scraper import db_util
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+from scraper import export  # noqa: E402
+
+
+def _app(appid, **kwargs):
+    row = {'appId': appid, 'title': 'Spy ' + appid, 'time': '20200101:1010',
+           'LANG': 'en', 'COUNTRY': 'us'}
+    row.update(kwargs)
+    return row
+
+
+def test_chunks_with_different_values_share_one_schema(db, tmp_path):
+    table = db.get_table(db_util.app_table_name('android'))
+    # Chunks of one row each, whose values pa.array would type differently
+    table.insert(_app('a', price=0, score=4, histogram=json.dumps({'1': 3}),
+                      screenshots=json.dumps([]), updated=1577836800000))
+    table.insert(_app('b', price='1.99', score=None, histogram=json.dumps({}),
+                      screenshots=json.dumps(['x.png']), updated='Jan 1, 2020',
+                      time='20200102:1010'))
+    table.insert(_app('c', price=None, score='n/a', histogram='not json',
+                      screenshots=None, updated=None))
+    assert export.export_table('apps', 'android', str(tmp_path), chunk_size=1) == 3
+
+    data = pq.read_table(str(tmp_path / 'apps'))
+    assert data.schema.field('price').type == pa.float64()
+    assert data.schema.field('histogram').type == pa.map_(pa.string(), pa.int64())
+    assert data.schema.field('screenshots').type == pa.list_(pa.string())
+    assert data.schema.field('updated').type == pa.string()
+    rows = {r['appId']: r for r in data.to_pylist()}
+    assert rows['a']['price'] == 0 and rows['b']['price'] == 1.99
+    assert rows['a']['histogram'] == [('1', 3)]
+    assert rows['b']['screenshots'] == ['x.png']
+    assert rows['c']['score'] is None and rows['c']['histogram'] is None
+    assert sorted(str(r['crawl_date']) for r in rows.values()) == \
+        ['20200101', '20200101', '20200102']
+
+
+def test_export_is_incremental(db, tmp_path):
+    table = db.get_table(db_util.term_table_name('android'))
+    table.insert({'term': 'spy', 'terms': json.dumps({'spy': None}),
+                  'apps': json.dumps(['a']), 'time': '20200101:1010',
+                  'LANG': 'en', 'COUNTRY': 'us'})
+    assert export.export_table('terms', 'android', str(tmp_path)) == 1
+    assert export.export_table('terms', 'android', str(tmp_path)) == 0
+    terms = pq.read_table(str(tmp_path / 'terms')).to_pylist()
+    assert terms[0]['terms'] == [{'term': 'spy', 'parent': None}]
+    assert terms[0]['apps'] == ['a']
+
+
+def test_reviews_are_only_partitioned_by_store(db, tmp_path):
+    table = db.get_table(db_util.reviews_table_name('android'),
+                         primary_id='id', primary_type=db.types.string)
+    table.insert({'id': 'gp:1', 'appId': 'a', 'score': 5, 'text': 'ok'})
+    assert export.export_table('reviews', 'android', str(tmp_path)) == 1
+    assert [p.name for p in (tmp_path / 'reviews').iterdir()] == ['store=android']
+    review = pq.read_table(str(tmp_path / 'reviews')).to_pylist()[0]
+    assert review['score'] == 5 and 'crawl_date' not in review
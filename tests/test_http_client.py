@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+
+requests = pytest.importorskip('requests')
+from scraper import config, http_client  # noqa: E402
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, timeout=None, **kwargs):
+        self.calls += 1
+        r = self.responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
+@pytest.fixture
+def host(monkeypatch, fast_ratelimit):
+    """Routes http_client.get to a FakeSession, without backoff sleeps"""
+    monkeypatch.setattr(http_client, '_backoff', lambda attempt: 0)
+    monkeypatch.setattr(config, 'HTTP_BREAKER_THRESHOLD', 2)
+
+    def _host(responses):
+        session = FakeSession(responses)
+        breaker = http_client._Breaker('example.com')
+        monkeypatch.setattr(http_client, '_get_host', lambda h: (session, breaker))
+        return session, breaker
+    return _host
+
+
+def test_retries_connection_errors_and_5xx(host):
+    session, _ = host([requests.ConnectionError('reset'), FakeResponse(500),
+                       FakeResponse(200)])
+    r = http_client.get('https://example.com/q', 'google', 'complete', retries=3)
+    assert r.status_code == 200 and session.calls == 3
+
+
+def test_gives_up_after_the_retries(host):
+    session, _ = host([FakeResponse(500)] * 3)
+    r = http_client.get('https://example.com/q', 'google', 'complete', retries=2)
+    assert r.status_code == 500 and session.calls == 3
+    host([requests.Timeout('slow')] * 2)
+    with pytest.raises(requests.Timeout):
+        http_client.get('https://example.com/q', 'google', 'complete', retries=1)
+
+
+def test_breaker_opens_on_throttling(host):
+    session, breaker = host([FakeResponse(429, {'Retry-After': '5'})] * 2)
+    http_client.get('https://example.com/q', 'google', 'complete', retries=1)
+    with pytest.raises(http_client.CircuitOpen):
+        http_client.get('https://example.com/q', 'google', 'complete')
+    assert session.calls == 2
+
+
+def test_aget(host):
+    host([FakeResponse(200)])
+    r = asyncio.run(http_client.aget('https://example.com/q', 'google', 'complete'))
+    assert r.status_code == 200
@@ -0,0 +1,48 @@
+import pytest
+from scraper import config, metrics
+
+
+@pytest.fixture(autouse=True)
+def _fresh(monkeypatch):
+    monkeypatch.setattr(metrics, '_metrics', {})
+    monkeypatch.setattr(config, 'METRICS_SNAPSHOT_EVERY', 3600)
+
+
+def test_results_and_latency_buckets():
+    metrics.record('android', 'app', 0.07, {'appId': 'a'})
+    metrics.record('android', 'app', 3, [])
+    metrics.record('android', 'app', 100, error=True)
+    m = metrics.get_metrics()['android_app']
+    assert m['calls'] == 3
+    assert m['results'] == {'ok': 1, 'empty': 1, 'error': 1}
+    assert m['latency_buckets']['0.1'] == 1
+    assert m['latency_buckets']['5'] == 1
+    # above the last bucket, only in +Inf
+    assert sum(m['latency_buckets'].values()) == 2
+
+
+def test_payload_is_sampled(monkeypatch):
+    monkeypatch.setattr(config, 'METRICS_PAYLOAD_SAMPLE', 10)
+    for _ in range(25):
+        metrics.record('android', 'app', 0.1, {'appId': 'a'})
+    m = metrics.get_metrics()['android_app']
+    assert m['payload_sampled'] == 3
+    assert m['payload_bytes'] == 3 * 10 * m['payload_max']
+    monkeypatch.setattr(config, 'METRICS_PAYLOAD_SAMPLE', 0)
+    metrics.record('android', 'similar', 0.1, ['a'])
+    assert metrics.get_metrics()['android_similar']['payload_sampled'] == 0
+
+
+def test_prometheus_format():
+    metrics.record('android', 'app', 0.07, {'appId': 'a'})
+    lines = metrics.to_prometheus().splitlines()
+    assert lines[0] == '# TYPE appscraper_store_calls_total counter'
+    assert 'appscraper_store_calls_total{store="android",endpoint="app",result="ok"} 1' in lines
+    assert 'appscraper_store_latency_seconds_bucket{store="android",endpoint="app",le="+Inf"} 1' in lines
+    assert 'appscraper_store_latency_seconds_count{store="android",endpoint="app"} 1' in lines
+
+
+def test_snapshot(tmp_path):
+    metrics.record('android', 'app', 0.07, {'appId': 'a'})
+    metrics.snapshot(str(tmp_path / 'm'))
+    assert (tmp_path / 'm.json').exists() and (tmp_path / 'm.prom').exists()
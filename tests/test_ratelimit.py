@@ -0,0 +1,51 @@
+import time
+import pytest
+from scraper import config, ratelimit
+from scraper.ratelimit import TokenBucket, OK, EMPTY, ERROR
+
+
+def test_success_increases_the_rate_additively():
+    bucket = TokenBucket('t', 2, min_rate=0.1, max_rate=10)
+    bucket.report(OK)
+    assert bucket.rate == pytest.approx(2 + config.RATE_LIMIT_INCREASE / 2)
+
+
+def test_error_and_empty_decrease_the_rate_multiplicatively():
+    bucket = TokenBucket('t', 4, min_rate=0.1, max_rate=10)
+    bucket.report(ERROR)
+    assert bucket.rate == pytest.approx(4 * config.RATE_LIMIT_DECREASE)
+    rate = bucket.rate
+    bucket.report(EMPTY)
+    assert bucket.rate == pytest.approx(rate * config.RATE_LIMIT_EMPTY_DECREASE)
+    # and no burst right after a failure
+    assert bucket.tokens <= 0
+
+
+def test_rate_stays_within_bounds():
+    bucket = TokenBucket('t', 1, min_rate=0.5, max_rate=1.05)
+    for _ in range(10):
+        bucket.report(ERROR)
+    assert bucket.rate == 0.5
+    for _ in range(100):
+        bucket.report(OK)
+    assert bucket.rate == 1.05
+
+
+def test_acquire_waits_for_tokens():
+    bucket = TokenBucket('t', 20)
+    t = time.time()
+    for _ in range(6):
+        bucket.acquire()
+    # one token to start with, then 20 per second
+    assert time.time() - t >= 4 / 20.0
+
+
+def test_buckets_are_per_store_endpoint_and_locale(monkeypatch):
+    monkeypatch.setattr(config, 'RATE_LIMITS', {'reviews': 2})
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+    reviews = ratelimit.get_bucket('android', 'reviews', locale='en_us')
+    assert reviews.rate == 2
+    assert ratelimit.get_bucket('android', 'reviews', locale='en_us') is reviews
+    assert ratelimit.get_bucket('android', 'reviews', locale='it_it') is not reviews
+    assert ratelimit.get_bucket('android', 'app', locale='en_us').rate == \
+        config.THROTTLE_DEFAULT
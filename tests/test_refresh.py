@@ -0,0 +1,98 @@
+import time
+from scraper import config, refresh
+
+
+def test_priority_new_apps_first():
+    now = time.time()
+    assert refresh.priority(None, now) == (0, 0)
+    assert refresh.priority({'last_fetched': None}, now) == (0, 0)
+    assert refresh.priority({'last_fetched': now - 10 * 86400}, now) > (0, 0)
+
+
+def test_priority_skips_recently_fetched_apps():
+    now = time.time()
+    info = {'last_fetched': now - config.REFRESH_MIN_INTERVAL / 2}
+    assert refresh.priority(info, now) is None
+
+
+def test_priority_most_overdue_first():
+    now = time.time()
+    # both fetched 4 days ago; one changes every day, the other every month
+    often = {'last_fetched': now - 4 * 86400, 'cadence': 86400}
+    rarely = {'last_fetched': now - 4 * 86400, 'cadence': 30 * 86400}
+    assert refresh.priority(often, now) < refresh.priority(rarely, now)
+    # same cadence, the one not looked at for longer first
+    older = {'last_fetched': now - 20 * 86400, 'cadence': 30 * 86400}
+    assert refresh.priority(older, now) < refresh.priority(rarely, now)
+
+
+def test_record_fetch_counts_changes(db):
+    app = {'appId': 'a', 'updated': 100, 'version': '1.0'}
+    refresh.record_fetch('android', 'a', app)
+    refresh.record_fetch('android', 'a', dict(app))
+    refresh.record_fetch('android', 'a', dict(app, updated=200, version='1.1'))
+    info = refresh.get_refresh_info('android')['a']
+    assert info['fetches'] == 3
+    assert info['changes'] == 2  # the first fetch, and the new version
+    assert info['version'] == '1.1'
+
+
+def test_fetch_recorder_writes_the_batch_on_flush(db):
+    recorder = refresh.FetchRecorder('android', ['a', 'b'])
+    recorder.record('a', {'appId': 'a', 'updated': 1})
+    recorder.record('b', None)  # gone from the store
+    assert refresh.get_refresh_info('android') == {}
+    recorder.flush()
+    infos = refresh.get_refresh_info('android')
+    assert sorted(infos) == ['a', 'b']
+    assert infos['b']['updated'] is None
+    # only the apps asked for
+    assert sorted(refresh.get_refresh_info('android', ['b', 'c'])) == ['b']
+
+
+def test_next_refresh_batch_order_and_budget(db):
+    now = int(time.time())
+    recorder = refresh.FetchRecorder('android', ['old', 'recent'])
+    recorder.record('old', {'appId': 'old', 'updated': 1})
+    recorder.record('recent', {'appId': 'recent', 'updated': 1})
+    recorder.flush()
+    db.query('update android_refresh set last_fetched=:t where "appId"=:a',
+             t=now - 30 * 86400, a='old')
+    batch = refresh.next_refresh_batch('android', ['recent', 'old', 'new'])
+    assert batch == ['new', 'old']
+    assert refresh.next_refresh_batch('android', ['old', 'new'], budget=1) == ['new']
+
+
+def test_probe():
+    now = time.time()
+    info = {'last_fetched': now - 86400, 'listing_hash': 42}
+    # never fetched, or no listing seen: fetch
+    assert refresh.probe(None, 42, now)
+    assert refresh.probe(info, None, now)
+    # same listing as at the last fetch: skip, unless that was long ago
+    assert not refresh.probe(info, 42, now)
+    assert refresh.probe(info, 43, now)
+    old = dict(info, last_fetched=now - config.PROBE_MAX_AGE - 1)
+    assert refresh.probe(old, 42, now)
+
+
+def test_next_refresh_batch_skips_unchanged_listings(db):
+    apps = [{'appId': a, 'title': a} for a in ['same', 'changed']]
+    refresh.record_listings('android', apps)
+    recorder = refresh.FetchRecorder('android', ['same', 'changed'])
+    for a in apps:
+        recorder.record(a['appId'], dict(a, updated=1))
+    recorder.flush()
+    db.query('update android_refresh set last_fetched=:t',
+             t=int(time.time()) - 2 * config.REFRESH_MIN_INTERVAL)
+    refresh.record_listings('android', [{'appId': 'changed', 'title': 'new title'}])
+    assert refresh.next_refresh_batch('android', ['same', 'changed']) == ['changed']
+
+
+def test_fetch_recorder_known_apps(db):
+    recorder = refresh.FetchRecorder('android', ['a'])
+    assert recorder.record('a', {'appId': 'a', 'updated': 1}) == (True, False)
+    recorder.flush()
+    recorder = refresh.FetchRecorder('android', ['a'])
+    assert recorder.record('a', {'appId': 'a', 'updated': 1}) == (False, True)
+    assert recorder.record('a', {'appId': 'a', 'updated': 2}) == (True, True)
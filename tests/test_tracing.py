@@ -0,0 +1,61 @@
+import threading
+import time
+import pytest
+from scraper import db_util, tracing
+
+
+@pytest.fixture(autouse=True)
+def _fresh(monkeypatch):
+    monkeypatch.setattr(tracing, '_spans', [])
+    monkeypatch.setattr(tracing, '_phases', [])
+    monkeypatch.setattr(tracing, '_self_time', tracing.defaultdict(float))
+    monkeypatch.setattr(tracing, '_counts', tracing.defaultdict(int))
+
+
+def test_nested_spans_count_self_time():
+    with tracing.span('terms', 'phase'):
+        with tracing.span('android_suggest', 'rpc') as rpc:
+            time.sleep(0.05)
+    s = tracing.summary()
+    assert s['phases'][0]['name'] == 'terms'
+    assert s['seconds']['rpc'] >= 0.05
+    # the rpc time is not counted again as python time of the phase
+    assert s['seconds']['python'] < 0.05
+    assert s['counts'] == {'rpc': 1, 'phase': 1}
+    assert rpc.parent == tracing._spans[-1].id
+
+
+def test_bind_keeps_the_parent_in_other_threads():
+    with tracing.span('apps', 'phase') as phase:
+        func = tracing.bind(lambda: tracing.start('app', 'app'))
+        spans = []
+        t = threading.Thread(target=lambda: spans.append(func()))
+        t.start()
+        t.join()
+    assert spans[0].parent == phase.id
+
+
+def test_errors_are_recorded():
+    with pytest.raises(ValueError):
+        with tracing.span('app', 'app'):
+            raise ValueError('gone')
+    assert 'gone' in tracing._spans[-1].attrs['error']
+
+
+def test_chrome_trace():
+    with tracing.span('app', 'app', appId='a'):
+        pass
+    event = tracing.chrome_trace()['traceEvents'][0]
+    assert event['ph'] == 'X' and event['cat'] == 'app'
+    assert event['args']['appId'] == 'a'
+
+
+def test_db_statements_only_traced_with_trace_db(db, monkeypatch):
+    monkeypatch.setattr(db_util.config, 'TRACE_DB', False)
+    list(db.query('select 1'))
+    assert tracing.summary()['counts'] == {}
+    db_util.trace_db()
+    list(db.query('select 1'))
+    # raw DBAPI calls have no execution context
+    db.engine.raw_connection().cursor().execute('pragma user_version')
+    assert tracing.summary()['counts'] == {'db': 1}